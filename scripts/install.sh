@@ -2,7 +2,7 @@
 
 KLIPPER_PATH="${HOME}/klipper"
 REPO_PATH="${HOME}/nevermore-extended-servo"
-EXTENSIONS="nevermore_servo nevermore_servo_profile_manager"
+EXTENSIONS="nevermore_servo nevermore_servo_profile_manager nevermore_servo_tuner nevermore_servo_state"
 
 set -eu
 export LC_ALL=C
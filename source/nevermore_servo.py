@@ -7,9 +7,14 @@
 
 import collections
 import logging
+import math
+import os
 import threading
 
+from extras.gcode_macro import GetStatusWrapper, TemplateWrapper
 from extras.nevermore_servo_profile_manager import ProfileManager
+from extras.nevermore_servo_state import StateStore
+from extras.nevermore_servo_tuner import ServoTuner
 
 KELVIN_TO_CELSIUS = -273.15
 AMBIENT_TEMP = 25.0
@@ -17,12 +22,26 @@ PID_PARAM_BASE = 255.0
 MAX_MAINTHREAD_TIME = 5.0
 SERVO_PROFILE_VERSION = 1
 
+# Shared by all control types
+QUANTISER_PROFILE_OPTIONS = {
+    "flap_positions": ("floatlist", "%.3f", None, True),
+    "open_tolerance": (float, "%.3f", None, True),
+    "close_tolerance": (float, "%.3f", None, True),
+    "dwell_time": (float, "%.3f", 0.0, True),
+}
+# (minval, maxval)
+QUANTISER_LIMITS = {
+    "open_tolerance": (0.0, 1.0),
+    "close_tolerance": (0.0, 1.0),
+    "dwell_time": (0.0, None),
+}
 WATERMARK_PROFILE_OPTIONS = {
     "control": (str, "%s", "watermark", False),
     "max_delta": (float, "%.4f", 2.0, True),
     "reverse": (bool, "%s", False, True),
     "min_percent": (float, "%.3f", 0.0, True),
     "max_percent": (float, "%.3f", 1.0, True),
+    **QUANTISER_PROFILE_OPTIONS,
 }
 # (type, placeholder, default, can_be_none)
 PID_PROFILE_OPTIONS = {
@@ -35,9 +54,63 @@ PID_PROFILE_OPTIONS = {
     "reverse": (bool, "%s", False, True),
     "min_percent": (float, "%.3f", 0.0, True),
     "max_percent": (float, "%.3f", 1.0, True),
+    "adaptive": (bool, "%s", False, True),
+    "adaptive_forgetting": (float, "%.4f", 0.995, True),
+    "adaptive_limit": (float, "%.3f", 2.0, True),
+    "adaptive_excitation": (float, "%.3f", 0.05, True),
+    "adaptive_nominal_gain": (float, "%.4f", None, True),
+    "adaptive_nominal_time_constant": (float, "%.2f", None, True),
+    **QUANTISER_PROFILE_OPTIONS,
+}
+# (above, minval, maxval)
+PID_LIMITS = {
+    "smooth_time": (0.0, None, None),
+    "smoothing_elements": (0.0, None, None),
+    "adaptive_forgetting": (None, 0.5, 1.0),
+    "adaptive_limit": (None, 1.0, None),
+    "adaptive_excitation": (None, 0.0, 0.5),
+    "adaptive_nominal_time_constant": (0.0, None, None),
 }
+FEEDFORWARD_PROFILE_OPTIONS = dict(
+    PID_PROFILE_OPTIONS,
+    **{
+        "control": (str, "%s", "feedforward", False),
+        "feedforward_heaters": (str, "%s", None, False),
+        "feedforward_gain": (float, "%.3f", None, False),
+        "feedforward_input": (str, "%s", "power", True),
+    }
+)
+FEEDFORWARD_INPUTS = ("power", "target")
+MPC_PROFILE_OPTIONS = dict(
+    PID_PROFILE_OPTIONS,
+    **{
+        "control": (str, "%s", "mpc", False),
+        "mpc_plant_gain": (float, "%.4f", None, False),
+        "mpc_time_constant": (float, "%.2f", None, False),
+        "mpc_horizon": (float, "%.1f", 300.0, True),
+        "mpc_steps": (int, "%d", 10, True),
+        "mpc_actuation_penalty": (float, "%.4f", 1.0, True),
+        "mpc_timeout": (float, "%.1f", 30.0, True),
+    }
+)
+MPC_LIMITS = dict(
+    PID_LIMITS,
+    **{
+        "mpc_time_constant": (0.0, None, None),
+        "mpc_horizon": (0.0, None, None),
+        "mpc_steps": (None, 2, None),
+        "mpc_actuation_penalty": (None, 0.0, None),
+        "mpc_timeout": (0.0, None, None),
+    }
+)
 TEMPLATE_PROFILE_OPTIONS = {
     "control": (str, "%s", "template", False),
+    "template": (str, "%s", None, False),
+    "template_inputs": (str, "%s", None, True),
+    "template_min_interval": (float, "%.3f", 0.0, True),
+    "min_percent": (float, "%.3f", 0.0, True),
+    "max_percent": (float, "%.3f", 1.0, True),
+    **QUANTISER_PROFILE_OPTIONS,
 }
 
 
@@ -51,7 +124,8 @@ class NevermoreServo:
         self.gcode = self.printer.lookup_object("gcode")
         self.configfile = self.printer.lookup_object("configfile")
         self.last_temp = 0.0
-        self.last_percent = 0.0
+        self.sensor_dropouts = 0
+        self.last_read_time = None
         self.measured_min = 99999999.0
         self.measured_max = -99999999.0
         self.reactor = self.printer.get_reactor()
@@ -77,6 +151,20 @@ class NevermoreServo:
             placeholder,
             default,
             can_be_none,
+        ) in FEEDFORWARD_PROFILE_OPTIONS.items():
+            config.get(key, None)
+        for key, (
+            type,
+            placeholder,
+            default,
+            can_be_none,
+        ) in MPC_PROFILE_OPTIONS.items():
+            config.get(key, None)
+        for key, (
+            type,
+            placeholder,
+            default,
+            can_be_none,
         ) in TEMPLATE_PROFILE_OPTIONS.items():
             config.get(key, None)
 
@@ -87,8 +175,16 @@ class NevermoreServo:
             self.nevermore = self.printer.load_object(config, "nevermore")
         else:
             self.nevermore = self.printer.load_object(config, self.nevermore_name)
+        self.vent = VentServoTracker.install(self.nevermore)
 
         self.hold_time = self.config.getfloat("hold_time", 0.5, above=0.0)
+        self.hold_mode = self.config.getchoice(
+            "hold_mode", {"fixed": "fixed", "adaptive": "adaptive"}, "fixed"
+        )
+        self.servo_travel_time = self.config.getfloat(
+            "servo_travel_time", 1.0, above=0.0
+        )
+        self.hold_margin = self.config.getfloat("hold_margin", 0.1, minval=0.0)
         self.update_tolerance = self.config.getfloat(
             "update_tolerance", 0.05, minval=0.0, maxval=1.0
         )
@@ -123,6 +219,15 @@ class NevermoreServo:
             maxval=self.max_temp,
         )
         self.target_temp = self.target_temp_conf
+        self.ramp = None
+
+        self.disturbance = None
+        if (
+            config.get("disturbance_slope", None) is not None
+            or config.get("disturbance_residual", None) is not None
+            or config.get("door_button", None) is not None
+        ):
+            self.disturbance = DisturbanceDetector(self, config)
 
         self.register_as_heater = config.getboolean("register_as_heater", False)
         if self.register_as_heater:
@@ -143,8 +248,10 @@ class NevermoreServo:
             {
                 "watermark": ControlBangBang,
                 "pid": ControlPID,
+                "feedforward": ControlFeedForward,
+                "mpc": ControlMPC,
                 #                "manual": ControlManual,
-                #                "template": ControlTemplate,
+                "template": ControlTemplate,
             }
         )
         self.pmgr = ProfileManager(self, self.control_types)
@@ -155,6 +262,23 @@ class NevermoreServo:
                 "Default Nevermore Servo-Profile could not be loaded."
             )
 
+        config_dir = os.path.dirname(self.printer.get_start_args()["config_file"])
+        state_file = config.get(
+            "state_file",
+            os.path.join(config_dir, ".nevermore_servo_%s.json" % (self.name,)),
+        )
+        state_save_interval = config.getfloat("state_save_interval", 60.0, minval=0.0)
+        state_max_age = config.getfloat("state_max_age", 600.0, above=0.0)
+        self.state_store = None
+        if state_save_interval:
+            self.state_store = StateStore(
+                self,
+                os.path.expanduser(state_file),
+                state_save_interval,
+                state_max_age,
+            )
+            self.restore_runtime_state(self.state_store.load())
+
         self.gcode.register_mux_command(
             "NEVERMORE_SERVO_PROFILE",
             "NEVERMORE_SERVO",
@@ -169,6 +293,27 @@ class NevermoreServo:
             self.cmd_SET_NEVERMORE_SERVO,
             desc=self.cmd_SET_NEVERMORE_SERVO_help,
         )
+        self.gcode.register_mux_command(
+            "NEVERMORE_SERVO_RAMP",
+            "NEVERMORE_SERVO",
+            self.name,
+            self.cmd_NEVERMORE_SERVO_RAMP,
+            desc=self.cmd_NEVERMORE_SERVO_RAMP_help,
+        )
+        self.printer.register_event_handler(
+            "idle_timeout:printing", self._handle_printing
+        )
+        self.printer.register_event_handler(
+            "klippy:disconnect", self._handle_disconnect
+        )
+        self.tuner = ServoTuner(self, PID_PARAM_BASE)
+        self.gcode.register_mux_command(
+            "NEVERMORE_SERVO_AUTOTUNE",
+            "NEVERMORE_SERVO",
+            self.name,
+            self.tuner.cmd_NEVERMORE_SERVO_AUTOTUNE,
+            desc=self.tuner.cmd_NEVERMORE_SERVO_AUTOTUNE_help,
+        )
 
     def _handle_connect(self):
         self.temperature_sensor = self.printer.lookup_object(self.temp_sensor_name)
@@ -188,6 +333,22 @@ class NevermoreServo:
         # Start temperature update timer
         self.reactor.update_timer(self.temp_sample_timer, self.reactor.NOW)
 
+    def _handle_printing(self, print_time):
+        # Let feed-forward controls react without waiting for the next sample,
+        # the last sample time keeps the sensor's time base
+        if (
+            getattr(self.control, "preposition", False)
+            and self.last_read_time is not None
+        ):
+            self.temperature_callback(self.last_read_time, self.last_temp)
+
+    def _handle_disconnect(self):
+        # Klipper restarts within the same process, solver threads of the
+        # active and the cached control must not keep this servo alive
+        for control in (self.control, self.pmgr.cached_control):
+            if control is not None and hasattr(control, "stop"):
+                control.stop()
+
     cmd_SET_NEVERMORE_SERVO_help = "Sets a nevermore_servo target temperature"
 
     def cmd_SET_NEVERMORE_SERVO(self, gcmd):
@@ -196,6 +357,28 @@ class NevermoreServo:
         self.set_temp(degrees)
         self.hold_time = hold_for
 
+    cmd_NEVERMORE_SERVO_RAMP_help = (
+        "Ramps a nevermore_servo target temperature at a given rate"
+    )
+
+    def cmd_NEVERMORE_SERVO_RAMP(self, gcmd):
+        target = gcmd.get_float("TARGET", minval=self.min_temp, maxval=self.max_temp)
+        rate = gcmd.get_float("RATE", above=0.0)
+        soak = gcmd.get_float("SOAK", 0.0, minval=0.0)
+        end_target = gcmd.get_float("END_TARGET", target, minval=0.0)
+        if end_target and (end_target < self.min_temp or end_target > self.max_temp):
+            raise gcmd.error(
+                "Requested end temperature (%.1f) out of range (%.1f:%.1f)"
+                % (end_target, self.min_temp, self.max_temp)
+            )
+        with self.lock:
+            if hasattr(self.control, "check_valid"):
+                self.control.check_valid()
+            start_temp = self.target_temp
+            if not start_temp:
+                start_temp = max(self.min_temp, min(self.max_temp, self.last_temp))
+            self.ramp = TargetRamp(start_temp, target, rate / 60.0, soak, end_target)
+
     def _temp_callback_timer(self, eventtime):
         measured_time = self.reactor.monotonic()
         self.temperature_callback(
@@ -206,16 +389,52 @@ class NevermoreServo:
         return measured_time + self.report_time
 
     def temperature_callback(self, read_time, temp):
-        self.last_temp = temp
-        if temp:
+        if temp is None or math.isnan(temp):
+            # Sensor dropout, keep the last state and leave the flap alone
+            self.sensor_dropouts += 1
+            return
+        with self.lock:
+            self.last_temp = temp
+            self.last_read_time = read_time
             self.measured_min = min(self.measured_min, temp)
             self.measured_max = max(self.measured_max, temp)
-        if self.control is None:
-            return
-        percent = self.control.angle_update(read_time, temp, self.target_temp)
-        if abs(percent - self.last_percent) > self.update_tolerance:
-            self.last_percent = percent
-            self.nevermore.set_vent_servo(percent, self.hold_time)
+            if self.ramp is not None:
+                self.target_temp = self.ramp.evaluate(read_time)
+                if self.ramp.state == "done":
+                    self.ramp = None
+            control = self.control
+            if control is None:
+                return
+            if self.disturbance is not None:
+                was_active = self.disturbance.active
+                self.disturbance.update(read_time, temp)
+                if self.disturbance.active:
+                    # Hold the controller and the flap until the chamber settles
+                    return
+                if was_active and hasattr(control, "resume"):
+                    control.resume()
+            percent = control.angle_update(read_time, temp, self.target_temp)
+            percent = control.quantiser.update(read_time, percent, self.last_percent)
+            if percent is not None:
+                hold_time = self.get_hold_time(percent)
+                self.nevermore.set_vent_servo(percent, hold_time)
+
+    @property
+    def last_percent(self):
+        # Shared with every other user of the nevermore vent servo
+        position = self.vent.position
+        return 0.0 if position is None else position
+
+    @last_percent.setter
+    def last_percent(self, percent):
+        self.vent.position = percent
+
+    def get_hold_time(self, percent):
+        if self.hold_mode == "fixed" or self.vent.position is None:
+            return self.hold_time
+        # Long enough for the travel, hold_time stays the upper bound
+        travel = abs(percent - self.vent.position)
+        return min(self.hold_time, travel * self.servo_travel_time + self.hold_margin)
 
     def set_temp(self, degrees):
         if degrees and (degrees < self.min_temp or degrees > self.max_temp):
@@ -226,6 +445,7 @@ class NevermoreServo:
         with self.lock:
             if degrees != 0.0 and hasattr(self.control, "check_valid"):
                 self.control.check_valid()
+            self.ramp = None
             self.target_temp = degrees
 
     def get_temp(self, eventtime):
@@ -250,6 +470,8 @@ class NevermoreServo:
         with self.lock:
             old_control = self.control
             self.control = control
+        if old_control is not None and hasattr(old_control, "stop"):
+            old_control.stop()
         return old_control
 
     def get_control(self):
@@ -268,14 +490,264 @@ class NevermoreServo:
             last_pwm_value,
         )
 
+    def get_runtime_state(self):
+        with self.lock:
+            control = self.control
+            state = {
+                "last_percent": self.last_percent,
+                "measured_min": self.measured_min,
+                "measured_max": self.measured_max,
+                "servo_stats": self.vent.get_stats(),
+            }
+        if control is not None:
+            state["profile"] = control.get_profile()["name"]
+            state["control"] = control.get_type()
+            state["control_state"] = control.get_state()
+        return state
+
+    def restore_runtime_state(self, state):
+        if state is None:
+            return
+        self.vent.restore_stats(state.get("servo_stats", {}))
+        if not state.get("recent", True):
+            return
+        with self.lock:
+            self.last_percent = state.get("last_percent", self.last_percent)
+            self.measured_min = state.get("measured_min", self.measured_min)
+            self.measured_max = state.get("measured_max", self.measured_max)
+            control = self.control
+            if (
+                control is not None
+                and state.get("control") == control.get_type()
+                and state.get("profile") == control.get_profile()["name"]
+            ):
+                control.set_state(state.get("control_state", {}))
+        logging.info("nevermore_servo: [%s] restored runtime state", self.name)
+
     def get_status(self, eventtime):
-        return {
+        control = self.control
+        status = {
             "temperature": round(self.last_temp, 2),
             "measured_min_temp": round(self.measured_min, 2),
             "measured_max_temp": round(self.measured_max, 2),
             "target": self.target_temp,
             "power": self.last_percent,
-            "control": self.control.get_type(),
+            "flap_position_known": self.vent.position is not None,
+            "servo": dict(self.vent.get_stats(), hold_mode=self.hold_mode),
+            "control": "manual" if control is None else control.get_type(),
+            "sensor_dropouts": self.sensor_dropouts,
+        }
+        ramp = self.ramp
+        if ramp is not None:
+            status["ramp"] = ramp.get_status()
+        if self.disturbance is not None:
+            status["disturbance"] = self.disturbance.get_status()
+        if control is None:
+            return status
+        status["quantiser"] = control.quantiser.get_status()
+        if hasattr(control, "get_status"):
+            status.update(control.get_status(eventtime))
+        return status
+
+
+class VentServoTracker:
+    # Records the last position commanded through set_vent_servo, no matter
+    # if it came from this plugin, another nevermore_servo or a macro
+    @staticmethod
+    def install(nevermore):
+        tracker = getattr(nevermore, "nevermore_servo_tracker", None)
+        if tracker is None:
+            tracker = VentServoTracker(nevermore)
+            nevermore.nevermore_servo_tracker = tracker
+        return tracker
+
+    def __init__(self, nevermore):
+        self.set_vent_servo = nevermore.set_vent_servo
+        self.position = None
+        self.moves = 0
+        self.travel = 0.0
+        self.energized_time = 0.0
+        self.indefinite_holds = 0
+        self.last_hold_time = None
+        nevermore.set_vent_servo = self._set_vent_servo
+
+    def _set_vent_servo(self, percent, *args, **kwargs):
+        if percent is not None:
+            self.moves += 1
+            if self.position is not None:
+                self.travel += abs(percent - self.position)
+            hold_time = args[0] if args else kwargs.get("hold_for")
+            self.last_hold_time = hold_time
+            if hold_time is None:
+                # Held until the next move, the duration is not known here
+                self.indefinite_holds += 1
+            elif isinstance(hold_time, (int, float)):
+                self.energized_time += hold_time
+            self.position = percent
+        # None releases the servo, the flap stays where it is
+        return self.set_vent_servo(percent, *args, **kwargs)
+
+    def get_stats(self):
+        return {
+            "moves": self.moves,
+            "travel": round(self.travel, 3),
+            "energized_time": round(self.energized_time, 3),
+            "indefinite_holds": self.indefinite_holds,
+            "last_hold_time": self.last_hold_time,
+        }
+
+    def restore_stats(self, stats):
+        # Several nevermore_servo sections may restore the same counters
+        self.moves = max(self.moves, stats.get("moves", 0))
+        self.travel = max(self.travel, stats.get("travel", 0.0))
+        self.energized_time = max(
+            self.energized_time, stats.get("energized_time", 0.0)
+        )
+        self.indefinite_holds = max(
+            self.indefinite_holds, stats.get("indefinite_holds", 0)
+        )
+
+
+class TargetRamp:
+    # Linear target ramp followed by an optional soak, driven by sample times.
+    # After the soak the target switches to end_target.
+    def __init__(self, start_temp, target, rate, soak, end_target):
+        self.start_temp = start_temp
+        self.target = target
+        self.end_target = end_target
+        self.rate = rate if target >= start_temp else -rate
+        self.soak = soak
+        self.ramp_time = abs(target - start_temp) / rate
+        self.start_time = None
+        self.state = "ramping"
+
+    def evaluate(self, read_time):
+        if self.start_time is None:
+            self.start_time = read_time
+        elapsed = read_time - self.start_time
+        if elapsed < self.ramp_time:
+            return self.start_temp + self.rate * elapsed
+        if elapsed < self.ramp_time + self.soak:
+            self.state = "soaking"
+            return self.target
+        self.state = "done"
+        return self.end_target
+
+    def get_status(self):
+        return {
+            "state": self.state,
+            "target": self.target,
+            "rate": abs(self.rate) * 60.0,
+            "soak": self.soak,
+            "end_target": self.end_target,
+        }
+
+
+DISTURBANCE_TREND_TIME = 30.0
+DISTURBANCE_RESIDUAL_TIME = 10.0
+DOOR_OPEN_STATES = {"pressed": "PRESSED", "released": "RELEASED"}
+
+
+class DisturbanceDetector:
+    # The trend is a line fitted over the last DISTURBANCE_TREND_TIME seconds,
+    # single samples are too noisy to compare with the thresholds directly
+    def __init__(self, servo, config):
+        self.servo = servo
+        self.printer = servo.printer
+        self.max_slope = config.getfloat("disturbance_slope", None, above=0.0)
+        self.max_residual = config.getfloat("disturbance_residual", None, above=0.0)
+        self.recovery_time = config.getfloat(
+            "disturbance_recovery_time", 30.0, minval=0.0
+        )
+        self.door_name = config.get("door_button", None)
+        self.door_open_state = config.getchoice(
+            "door_open_state", DOOR_OPEN_STATES, "released"
+        )
+        self.door = None
+        if self.door_name is not None:
+            self.printer.register_event_handler("klippy:connect", self._handle_connect)
+        self.samples = collections.deque()
+        self.prev_time = None
+        self.slope = 0.0
+        self.residual = 0.0
+        self.trend_valid = False
+        self.active = False
+        self.reason = None
+        self.calm_since = None
+
+    def _handle_connect(self):
+        self.door = self.printer.lookup_object("gcode_button %s" % (self.door_name,))
+
+    def _fit(self, read_time):
+        # Least squares line through the window, returns the temperature at
+        # read_time and the slope
+        samples = self.samples
+        count = len(samples)
+        mean_time = sum(t for t, temp in samples) / count
+        mean_temp = sum(temp for t, temp in samples) / count
+        var_time = sum((t - mean_time) ** 2 for t, temp in samples)
+        cov = sum((t - mean_time) * (temp - mean_temp) for t, temp in samples)
+        slope = cov / var_time
+        return mean_temp + slope * (read_time - mean_time), slope
+
+    def _check(self, read_time, temp):
+        door_open = (
+            self.door is not None
+            and self.door.get_status(read_time)["state"] == self.door_open_state
+        )
+        if self.prev_time is None or read_time > self.prev_time:
+            self._update_trend(read_time, temp)
+        if door_open:
+            return "door"
+        if not self.trend_valid:
+            return None
+        if self.max_slope is not None and self.slope < -self.max_slope:
+            return "slope"
+        if self.max_residual is not None and abs(self.residual) > self.max_residual:
+            return "residual"
+        return None
+
+    def _update_trend(self, read_time, temp):
+        samples = self.samples
+        if samples and read_time - samples[0][0] >= DISTURBANCE_TREND_TIME / 2.0:
+            # The residual is how far the recent samples are off the trend
+            # fitted before them
+            expected, self.slope = self._fit(read_time)
+            weight = min(1.0, (read_time - self.prev_time) / DISTURBANCE_RESIDUAL_TIME)
+            self.residual += (temp - expected - self.residual) * weight
+            self.trend_valid = True
+        samples.append((read_time, temp))
+        while read_time - samples[0][0] > DISTURBANCE_TREND_TIME:
+            samples.popleft()
+
+    def update(self, read_time, temp):
+        reason = self._check(read_time, temp)
+        if self.prev_time is None or read_time > self.prev_time:
+            self.prev_time = read_time
+        if reason is not None:
+            if not self.active:
+                logging.info(
+                    "nevermore_servo: [%s] disturbance detected (%s), holding flap",
+                    self.servo.name,
+                    reason,
+                )
+            self.active = True
+            self.reason = reason
+            self.calm_since = None
+        elif self.active:
+            if self.calm_since is None:
+                self.calm_since = read_time
+            if read_time - self.calm_since >= self.recovery_time:
+                self.active = False
+                self.reason = None
+                self.calm_since = None
+
+    def get_status(self):
+        return {
+            "active": self.active,
+            "reason": self.reason,
+            "slope": round(self.slope, 4),
+            "residual": round(self.residual, 4),
         }
 
 
@@ -293,6 +765,7 @@ class ControlBangBang:
                 above = 0.0
             else:
                 above = None
+            minval, maxval = QUANTISER_LIMITS.get(key, (None, None))
             temp_profile[key] = pmgr._check_value_config(
                 key,
                 config_section,
@@ -300,6 +773,8 @@ class ControlBangBang:
                 can_be_none,
                 default=default,
                 above=above,
+                minval=minval,
+                maxval=maxval,
             )
         if name != "default":
             profile_version = config_section.getint("profile_version", None)
@@ -314,7 +789,7 @@ class ControlBangBang:
 
     @staticmethod
     def set_values(pmgr, gcmd, control, profile_name):
-        current_profile = pmgr.servo.get_control().get_profile()
+        current_profile = pmgr.get_active_control().get_profile()
         max_delta = pmgr._check_value_gcmd(
             "MAX_DELTA",
             current_profile["max_delta"],
@@ -343,6 +818,7 @@ class ControlBangBang:
             "min_percent": min_percent,
             "max_percent": max_percent,
         }
+        temp_profile.update(FlapQuantiser.set_values(pmgr, gcmd, current_profile))
         temp_control = pmgr.servo.lookup_control(temp_profile)
         pmgr.servo.set_control(temp_control)
         msg = (
@@ -352,9 +828,10 @@ class ControlBangBang:
             "Reverse: %s\n"
             "Min Percent: %.3f\n"
             "Max Percent: %.3f\n"
-            "have been set as current profile."
             % (control, max_delta, reverse, min_percent, max_percent)
         )
+        msg += FlapQuantiser.load_console_message(temp_profile)
+        msg += "have been set as current profile."
         pmgr.servo.gcode.respond_info(msg)
 
     @staticmethod
@@ -370,7 +847,9 @@ class ControlBangBang:
         ) in WATERMARK_PROFILE_OPTIONS.items():
             value = temp_profile[key]
             if value is not None:
-                pmgr.servo.configfile.set(section_name, key, placeholder % value)
+                pmgr.servo.configfile.set(
+                    section_name, key, pmgr._format_value(placeholder, value)
+                )
         temp_profile["name"] = profile_name
         pmgr.profiles[profile_name] = temp_profile
         if verbose:
@@ -391,11 +870,13 @@ class ControlBangBang:
         msg += "Reverse: %s\n" % profile["reverse"]
         msg += "Min Percent: %.3f\n" % profile["min_percent"]
         msg += "Max Percent: %.3f\n" % profile["max_percent"]
+        msg += FlapQuantiser.load_console_message(profile)
         return msg
 
     def __init__(self, profile, servo):
         self.profile = profile
         self.servo = servo
+        self.quantiser = FlapQuantiser(profile, servo)
         self.max_delta = profile["max_delta"]
         self.reverse = profile["reverse"]
         self.min_percent = profile["min_percent"]
@@ -415,6 +896,12 @@ class ControlBangBang:
     def check_busy(self, eventtime, smoothed_temp, target_temp):
         return smoothed_temp < target_temp - self.max_delta
 
+    def get_state(self):
+        return {"heating": self.heating}
+
+    def set_state(self, state):
+        self.heating = state.get("heating", self.heating)
+
     def update_smooth_time(self):
         self.smooth_time = self.servo.get_smooth_time()  # smoothing window
 
@@ -431,35 +918,157 @@ class ControlBangBang:
         return "watermark"
 
 
+class FlapQuantiser:
+    # Decides whether and where the flap moves for a requested percentage
+    @staticmethod
+    def set_values(pmgr, gcmd, current_profile):
+        values = {}
+        for key, name, type in (
+            ("flap_positions", "FLAP_POSITIONS", "floatlist"),
+            ("open_tolerance", "OPEN_TOLERANCE", float),
+            ("close_tolerance", "CLOSE_TOLERANCE", float),
+            ("dwell_time", "DWELL_TIME", float),
+        ):
+            minval, maxval = QUANTISER_LIMITS.get(key, (None, None))
+            values[key] = pmgr._check_value_gcmd(
+                name,
+                current_profile.get(key),
+                gcmd,
+                type,
+                True,
+                minval=minval,
+                maxval=maxval,
+            )
+        return values
+
+    @staticmethod
+    def load_console_message(profile):
+        msg = ""
+        if profile.get("flap_positions"):
+            msg += "Flap Positions: %s\n" % ", ".join(
+                "%.3f" % p for p in profile["flap_positions"]
+            )
+        if profile.get("open_tolerance") is not None:
+            msg += "Open Tolerance: %.3f\n" % profile["open_tolerance"]
+        if profile.get("close_tolerance") is not None:
+            msg += "Close Tolerance: %.3f\n" % profile["close_tolerance"]
+        if profile.get("dwell_time"):
+            msg += "Dwell Time: %.3f\n" % profile["dwell_time"]
+        return msg
+
+    def __init__(self, profile, servo):
+        self.servo = servo
+        positions = profile.get("flap_positions")
+        self.positions = sorted(positions) if positions else None
+        self.open_tolerance = profile.get("open_tolerance")
+        self.close_tolerance = profile.get("close_tolerance")
+        self.dwell_time = profile.get("dwell_time") or 0.0
+        self.last_move_time = None
+        self.requested = None
+        self.decision = None
+
+    def _get_tolerances(self):
+        open_tolerance = self.open_tolerance
+        if open_tolerance is None:
+            open_tolerance = self.servo.update_tolerance
+        close_tolerance = self.close_tolerance
+        if close_tolerance is None:
+            close_tolerance = self.servo.update_tolerance
+        return open_tolerance, close_tolerance
+
+    def _snap(self, percent, current, open_tolerance, close_tolerance):
+        # Moving to a neighbouring position needs the request to pass the
+        # midpoint between both by the open or close tolerance
+        positions = self.positions
+        index = positions.index(current)
+        target = current
+        for lower, upper in zip(positions[index:], positions[index + 1 :]):
+            if percent < (lower + upper) / 2.0 + open_tolerance:
+                break
+            target = upper
+        if target != current:
+            return target
+        for lower, upper in reversed(
+            list(zip(positions[:index], positions[1 : index + 1]))
+        ):
+            if percent > (lower + upper) / 2.0 - close_tolerance:
+                break
+            target = lower
+        return target
+
+    def update(self, read_time, percent, last_percent):
+        self.requested = percent
+        open_tolerance, close_tolerance = self._get_tolerances()
+        delta = percent - last_percent
+        tolerance = open_tolerance if delta >= 0.0 else close_tolerance
+        if self.positions is not None:
+            current = min(self.positions, key=lambda p: abs(p - last_percent))
+            target = self._snap(percent, current, open_tolerance, close_tolerance)
+            # A flap moved off the positions by someone else is only snapped
+            # back once the request leaves the deadband around it
+            deadband = target == last_percent or (
+                target == current and abs(delta) <= tolerance
+            )
+        else:
+            target = percent
+            deadband = abs(delta) <= tolerance
+        if deadband:
+            self.decision = "deadband"
+            return None
+        if (
+            self.last_move_time is not None
+            and read_time - self.last_move_time < self.dwell_time
+        ):
+            self.decision = "dwell"
+            return None
+        self.last_move_time = read_time
+        self.decision = "open" if target > last_percent else "close"
+        return target
+
+    def get_status(self):
+        open_tolerance, close_tolerance = self._get_tolerances()
+        return {
+            "flap_positions": self.positions,
+            "open_tolerance": open_tolerance,
+            "close_tolerance": close_tolerance,
+            "dwell_time": self.dwell_time,
+            "requested": self.requested,
+            "decision": self.decision,
+        }
+
+
 PID_SETTLE_DELTA = 1.0
 PID_SETTLE_SLOPE = 0.1
 
 
 class ControlPID:
-    @staticmethod
-    def init_profile(config_section, name, pmgr):
+    PROFILE_OPTIONS = PID_PROFILE_OPTIONS
+    LIMITS = PID_LIMITS
+
+    @classmethod
+    def _limits(cls, key):
+        if key in QUANTISER_LIMITS:
+            minval, maxval = QUANTISER_LIMITS[key]
+            return {"above": None, "minval": minval, "maxval": maxval}
+        above, minval, maxval = cls.LIMITS.get(key, (None, None, None))
+        return {"above": above, "minval": minval, "maxval": maxval}
+
+    @classmethod
+    def init_profile(cls, config_section, name, pmgr):
         temp_profile = {}
         for key, (
             type,
             placeholder,
             default,
             can_be_none,
-        ) in PID_PROFILE_OPTIONS.items():
-            if (
-                key == "smooth_time"
-                or key == "smoothing_elements"
-                or key == "pid_tolerance"
-            ):
-                above = 0.0
-            else:
-                above = None
+        ) in cls.PROFILE_OPTIONS.items():
             temp_profile[key] = pmgr._check_value_config(
                 key,
                 config_section,
                 type,
                 can_be_none,
                 default=default,
-                above=above,
+                **cls._limits(key),
             )
         if name == "default":
             temp_profile["smooth_time"] = None
@@ -475,9 +1084,9 @@ class ControlPID:
                 return None
         return temp_profile
 
-    @staticmethod
-    def set_values(pmgr, gcmd, control, profile_name):
-        current_profile = pmgr.servo.get_control().get_profile()
+    @classmethod
+    def set_values(cls, pmgr, gcmd, control, profile_name):
+        current_profile = pmgr.get_active_control().get_profile()
         target = pmgr._check_value_gcmd("TARGET", None, gcmd, float, True)
         tolerance = pmgr._check_value_gcmd(
             "TOLERANCE",
@@ -489,9 +1098,16 @@ class ControlPID:
         kp = pmgr._check_value_gcmd("KP", None, gcmd, float, False)
         ki = pmgr._check_value_gcmd("KI", None, gcmd, float, False)
         kd = pmgr._check_value_gcmd("KD", None, gcmd, float, False)
-        smooth_time = pmgr._check_value_gcmd("SMOOTH_TIME", None, gcmd, float, True)
+        smooth_time = pmgr._check_value_gcmd(
+            "SMOOTH_TIME", None, gcmd, float, True, **cls._limits("smooth_time")
+        )
         smoothing_elements = pmgr._check_value_gcmd(
-            "SMOOTHING_ELEMENTS", None, gcmd, int, True
+            "SMOOTHING_ELEMENTS",
+            None,
+            gcmd,
+            int,
+            True,
+            **cls._limits("smoothing_elements"),
         )
         reverse = pmgr._check_value_gcmd("REVERSE", None, gcmd, bool, True)
         min_percent = pmgr._check_value_gcmd(
@@ -500,6 +1116,42 @@ class ControlPID:
         max_percent = pmgr._check_value_gcmd(
             "MAX_PERCENT", current_profile["max_percent"], gcmd, float, True
         )
+        adaptive = pmgr._check_value_gcmd("ADAPTIVE", None, gcmd, bool, True)
+        adaptive_forgetting = pmgr._check_value_gcmd(
+            "ADAPTIVE_FORGETTING",
+            PID_PROFILE_OPTIONS["adaptive_forgetting"][2],
+            gcmd,
+            float,
+            False,
+            **cls._limits("adaptive_forgetting"),
+        )
+        adaptive_limit = pmgr._check_value_gcmd(
+            "ADAPTIVE_LIMIT",
+            PID_PROFILE_OPTIONS["adaptive_limit"][2],
+            gcmd,
+            float,
+            False,
+            **cls._limits("adaptive_limit"),
+        )
+        adaptive_excitation = pmgr._check_value_gcmd(
+            "ADAPTIVE_EXCITATION",
+            PID_PROFILE_OPTIONS["adaptive_excitation"][2],
+            gcmd,
+            float,
+            False,
+            **cls._limits("adaptive_excitation"),
+        )
+        adaptive_nominal_gain = pmgr._check_value_gcmd(
+            "ADAPTIVE_NOMINAL_GAIN", None, gcmd, float, True
+        )
+        adaptive_nominal_time_constant = pmgr._check_value_gcmd(
+            "ADAPTIVE_NOMINAL_TIME_CONSTANT",
+            None,
+            gcmd,
+            float,
+            True,
+            **cls._limits("adaptive_nominal_time_constant"),
+        )
         temp_profile = {
             "name": profile_name,
             "control": control,
@@ -511,7 +1163,15 @@ class ControlPID:
             "reverse": reverse,
             "min_percent": min_percent,
             "max_percent": max_percent,
+            "adaptive": adaptive,
+            "adaptive_forgetting": adaptive_forgetting,
+            "adaptive_limit": adaptive_limit,
+            "adaptive_excitation": adaptive_excitation,
+            "adaptive_nominal_gain": adaptive_nominal_gain,
+            "adaptive_nominal_time_constant": adaptive_nominal_time_constant,
         }
+        temp_profile.update(FlapQuantiser.set_values(pmgr, gcmd, current_profile))
+        extra_msg = cls._set_extra_values(pmgr, gcmd, temp_profile)
         temp_control = pmgr.servo.lookup_control(temp_profile)
         pmgr.servo.set_control(temp_control)
         msg = "PID Parameters:\n"
@@ -530,14 +1190,34 @@ class ControlPID:
             msg += "Min Percent: %.3f\n" % min_percent
         if max_percent is not None:
             msg += "Max Percent: %.3f\n" % max_percent
+        if adaptive:
+            msg += "Adaptive: forgetting=%.4f limit=%.3f excitation=%.3f\n" % (
+                adaptive_forgetting,
+                adaptive_limit,
+                adaptive_excitation,
+            )
+            if (
+                adaptive_nominal_gain is not None
+                and adaptive_nominal_time_constant is not None
+            ):
+                msg += "Adaptive Nominal: gain=%.4f time_constant=%.2f\n" % (
+                    adaptive_nominal_gain,
+                    adaptive_nominal_time_constant,
+                )
+        msg += extra_msg
+        msg += FlapQuantiser.load_console_message(temp_profile)
         msg += (
             "pid_Kp=%.3f pid_Ki=%.3f pid_Kd=%.3f\n"
             "have been set as current profile." % (kp, ki, kd)
         )
         pmgr.servo.gcode.respond_info(msg)
 
-    @staticmethod
-    def save_profile(pmgr, temp_profile, profile_name=None, verbose=True):
+    @classmethod
+    def _set_extra_values(cls, pmgr, gcmd, temp_profile):
+        return ""
+
+    @classmethod
+    def save_profile(cls, pmgr, temp_profile, profile_name=None, verbose=True):
         if profile_name is None:
             profile_name = temp_profile["name"]
         section_name = pmgr._compute_section_name(profile_name)
@@ -549,10 +1229,12 @@ class ControlPID:
             placeholder,
             default,
             can_be_none,
-        ) in PID_PROFILE_OPTIONS.items():
+        ) in cls.PROFILE_OPTIONS.items():
             value = temp_profile[key]
             if value is not None:
-                pmgr.servo.configfile.set(section_name, key, placeholder % value)
+                pmgr.servo.configfile.set(
+                    section_name, key, pmgr._format_value(placeholder, value)
+                )
         temp_profile["name"] = profile_name
         pmgr.profiles[profile_name] = temp_profile
         if verbose:
@@ -564,8 +1246,8 @@ class ControlPID:
                 % (pmgr.servo.name, profile_name)
             )
 
-    @staticmethod
-    def load_console_message(profile, servo):
+    @classmethod
+    def load_console_message(cls, profile, servo):
         smooth_time = (
             servo.get_smooth_time()
             if profile["smooth_time"] is None
@@ -589,14 +1271,46 @@ class ControlPID:
         msg += "Reverse: %s" % profile["reverse"]
         msg += "Min Percent: %.3f\n" % profile["min_percent"]
         msg += "Max Percent: %.3f\n" % profile["max_percent"]
+        if profile["adaptive"]:
+            msg += "Adaptive: forgetting=%.4f limit=%.3f excitation=%.3f\n" % (
+                profile["adaptive_forgetting"],
+                profile["adaptive_limit"],
+                profile["adaptive_excitation"],
+            )
+            if (
+                profile["adaptive_nominal_gain"] is not None
+                and profile["adaptive_nominal_time_constant"] is not None
+            ):
+                msg += "Adaptive Nominal: gain=%.4f time_constant=%.2f\n" % (
+                    profile["adaptive_nominal_gain"],
+                    profile["adaptive_nominal_time_constant"],
+                )
+        msg += FlapQuantiser.load_console_message(profile)
         return msg
 
     def __init__(self, profile, servo):
         self.profile = profile
         self.servo = servo
+        self.quantiser = FlapQuantiser(profile, servo)
         self.Kp = profile["pid_kp"] / PID_PARAM_BASE
         self.Ki = profile["pid_ki"] / PID_PARAM_BASE
         self.Kd = profile["pid_kd"] / PID_PARAM_BASE
+        self.base_gains = (self.Kp, self.Ki, self.Kd)
+        self.estimator = None
+        if profile["adaptive"]:
+            self.estimator = ThermalEstimator(profile["adaptive_forgetting"])
+            self.adaptive_limit = profile["adaptive_limit"]
+            self.excitation = profile["adaptive_excitation"]
+            self.last_excitation = 0.0
+            self.nominal_model = None
+            if (
+                profile["adaptive_nominal_gain"] is not None
+                and profile["adaptive_nominal_time_constant"] is not None
+            ):
+                self.nominal_model = (
+                    profile["adaptive_nominal_gain"],
+                    profile["adaptive_nominal_time_constant"],
+                )
         self.reverse = profile["reverse"]
         self.min_percent = profile["min_percent"]
         self.max_percent = profile["max_percent"]
@@ -608,13 +1322,20 @@ class ControlPID:
         self.temp_integ_max = 0.0
         if self.Ki:
             self.temp_integ_max = self.max_percent / self.Ki
-        self.prev_temp = self.servo.get_temp(self.servo.reactor.monotonic())[0]
-        self.prev_temp_time = 0.0
+        self.prev_temp = None
+        self.prev_temp_time = None
         self.prev_temp_deriv = 0.0
         self.prev_temp_integ = 0.0
 
     def angle_update(self, read_time, temp, target_temp):
-        time_diff = read_time - self.prev_temp_time
+        if self.prev_temp_time is None:
+            # First sample, possibly with state restored from a previous run
+            self.prev_temp = temp
+            self.prev_temp_time = read_time
+        # Samples arriving out of order must not run the integrator backwards
+        time_diff = max(0.0, read_time - self.prev_temp_time)
+        if self.estimator is not None:
+            self._adapt(read_time, time_diff, temp)
         # Calculate change of temperature
         temp_diff = temp - self.prev_temp
         if time_diff >= self.min_deriv_time:
@@ -629,20 +1350,24 @@ class ControlPID:
         temp_integ = max(0.0, min(self.temp_integ_max, temp_integ))
         # Calculate output
         co = self.Kp * temp_err + self.Ki * temp_integ - self.Kd * temp_deriv
+        co += self.feedforward(read_time)
         # logging.debug("pid: %f@%.3f -> diff=%f deriv=%f err=%f integ=%f co=%d",
         #    temp, read_time, temp_diff, temp_deriv, temp_err, temp_integ, co)
         bounded_co = max(0.0, min(1.0, co))
         try:
             if not self.reverse:
-                return (
+                percent = (
                     max(0.0, bounded_co) * (self.max_percent - self.min_percent)
                     + self.min_percent
                 )
             else:
-                return (
+                percent = (
                     max(0.0, 1.0 - bounded_co) * (self.max_percent - self.min_percent)
                     + self.min_percent
                 )
+            if self.estimator is not None:
+                percent = self._excite(read_time, percent)
+            return percent
         finally:
             # Store state for next measurement
             self.prev_temp = temp
@@ -651,6 +1376,65 @@ class ControlPID:
             if co == bounded_co:
                 self.prev_temp_integ = temp_integ
 
+    def feedforward(self, read_time):
+        return 0.0
+
+    def _excite(self, read_time, percent):
+        # In closed loop the flap follows the temperature, so the chamber can
+        # not be told apart from the controller. A square wave on the flap
+        # that does not depend on the temperature makes it identifiable.
+        if (read_time // ADAPTIVE_EXCITATION_TIME) % 2:
+            excited = percent + self.excitation
+        else:
+            excited = percent - self.excitation
+        excited = max(self.min_percent, min(self.max_percent, excited))
+        self.last_excitation = excited - percent
+        return excited
+
+    def _adapt(self, read_time, time_diff, temp):
+        # The excitation is passed relative to its amplitude, which keeps the
+        # covariance comparable with ADAPTIVE_TRUST_COVARIANCE
+        excitation = 0.0
+        if self.excitation:
+            excitation = self.last_excitation / self.excitation
+        self.estimator.update(
+            read_time - time_diff,
+            time_diff,
+            temp,
+            self.servo.last_percent,
+            excitation,
+        )
+        model = self.estimator.get_model()
+        # Only estimates backed by enough excitation are used
+        if (
+            model is None
+            or self.estimator.get_uncertainty() >= ADAPTIVE_TRUST_COVARIANCE
+        ):
+            return
+        if self.nominal_model is None:
+            # The configured gains are assumed to fit the first trusted estimate
+            self.nominal_model = model
+            return
+        nominal_gain, nominal_tau = self.nominal_model
+        gain, tau = model
+        if (gain > 0.0) != (nominal_gain > 0.0):
+            return
+        limit = self.adaptive_limit
+        gain_scale = max(1.0 / limit, min(limit, nominal_gain / gain))
+        tau_scale = max(1.0 / limit, min(limit, tau / nominal_tau))
+        # Lambda tuning: keep the closed loop as fast as with the nominal model,
+        # a faster chamber needs less proportional action, not more integral
+        kp, ki, kd = self.base_gains
+        new_ki = ki * gain_scale
+        if self.Ki and new_ki:
+            # Keep the integral contribution constant
+            self.prev_temp_integ *= self.Ki / new_ki
+        self.Kp = kp * max(1.0 / limit, min(limit, gain_scale * tau_scale))
+        self.Ki = new_ki
+        self.Kd = kd * max(1.0 / limit, min(limit, gain_scale * tau_scale**2))
+        if self.Ki:
+            self.temp_integ_max = self.max_percent / self.Ki
+
     def check_busy(self, eventtime, smoothed_temp, target_temp):
         temp_diff = target_temp - smoothed_temp
         return (
@@ -661,6 +1445,26 @@ class ControlPID:
     def update_smooth_time(self):
         self.min_deriv_time = self.servo.get_smooth_time()  # smoothing window
 
+    def resume(self):
+        # Restart the derivative from the next sample, the integrator is kept
+        self.prev_temp_time = None
+
+    def get_state(self):
+        return {
+            "prev_temp_deriv": self.prev_temp_deriv,
+            "prev_temp_integ": self.prev_temp_integ,
+        }
+
+    def set_state(self, state):
+        self.prev_temp_deriv = state.get("prev_temp_deriv", self.prev_temp_deriv)
+        self.prev_temp_integ = max(
+            0.0,
+            min(
+                self.temp_integ_max,
+                state.get("prev_temp_integ", self.prev_temp_integ),
+            ),
+        )
+
     def set_pid_kp(self, kp):
         self.Kp = kp / PID_PARAM_BASE
 
@@ -678,7 +1482,7 @@ class ControlPID:
         self.profile["name"] = name
 
     def _load_console_message(self):
-        return ControlPID.load_console_message(self.profile, self.servo)
+        return type(self).load_console_message(self.profile, self.servo)
 
     def get_profile(self):
         return self.profile
@@ -686,6 +1490,706 @@ class ControlPID:
     def get_type(self):
         return "pid"
 
+    def get_status(self, eventtime):
+        if self.estimator is None:
+            return {}
+        model = self.estimator.get_model()
+        return {
+            "adaptive": {
+                "plant_gain": None if model is None else round(model[0], 4),
+                "time_constant": None if model is None else round(model[1], 2),
+                "nominal": self.nominal_model is not None,
+                "excitation": round(self.last_excitation, 3),
+                "pid_kp": round(self.Kp * PID_PARAM_BASE, 3),
+                "pid_ki": round(self.Ki * PID_PARAM_BASE, 3),
+                "pid_kd": round(self.Kd * PID_PARAM_BASE, 3),
+            }
+        }
+
+
+class ControlFeedForward(ControlPID):
+    PROFILE_OPTIONS = FEEDFORWARD_PROFILE_OPTIONS
+
+    @classmethod
+    def init_profile(cls, config_section, name, pmgr):
+        temp_profile = super().init_profile(config_section, name, pmgr)
+        if (
+            temp_profile is not None
+            and temp_profile["feedforward_input"] not in FEEDFORWARD_INPUTS
+        ):
+            raise config_section.error(
+                "nevermore_servo_profile: 'feedforward_input' has to be one of "
+                "%s in [%s]."
+                % (", ".join(FEEDFORWARD_INPUTS), config_section.get_name())
+            )
+        return temp_profile
+
+    @classmethod
+    def _set_extra_values(cls, pmgr, gcmd, temp_profile):
+        heaters = pmgr._check_value_gcmd("FEEDFORWARD_HEATERS", None, gcmd, str, False)
+        gain = pmgr._check_value_gcmd("FEEDFORWARD_GAIN", None, gcmd, float, False)
+        ff_input = pmgr._check_value_gcmd(
+            "FEEDFORWARD_INPUT", "power", gcmd, "lower", False
+        )
+        if ff_input not in FEEDFORWARD_INPUTS:
+            raise gcmd.error(
+                "nevermore_servo_profile: 'FEEDFORWARD_INPUT' has to be one of %s."
+                % (", ".join(FEEDFORWARD_INPUTS),)
+            )
+        temp_profile["feedforward_heaters"] = heaters
+        temp_profile["feedforward_gain"] = gain
+        temp_profile["feedforward_input"] = ff_input
+        return "Feed-Forward: heaters=%s gain=%.3f input=%s\n" % (
+            heaters,
+            gain,
+            ff_input,
+        )
+
+    @classmethod
+    def load_console_message(cls, profile, servo):
+        msg = super().load_console_message(profile, servo)
+        msg += "Feed-Forward: heaters=%s gain=%.3f input=%s\n" % (
+            profile["feedforward_heaters"],
+            profile["feedforward_gain"],
+            profile["feedforward_input"],
+        )
+        return msg
+
+    def __init__(self, profile, servo):
+        super().__init__(profile, servo)
+        self.heater_names = [
+            n.strip() for n in profile["feedforward_heaters"].split(",") if n.strip()
+        ]
+        self.Kff = profile["feedforward_gain"] / PID_PARAM_BASE
+        self.feedforward_input = profile["feedforward_input"]
+        self.heaters = None
+        self.last_feedforward = 0.0
+        self.preposition = True
+
+    def _lookup_heaters(self):
+        pheaters = self.servo.printer.lookup_object("heaters")
+        self.heaters = []
+        for name in self.heater_names:
+            try:
+                self.heaters.append(pheaters.lookup_heater(name))
+            except self.servo.printer.config_error:
+                logging.warning(
+                    "nevermore_servo: [%s] unknown feed-forward heater '%s'",
+                    self.servo.name,
+                    name,
+                )
+
+    def feedforward(self, read_time):
+        if self.heaters is None:
+            self._lookup_heaters()
+        total = 0.0
+        for heater in self.heaters:
+            total += heater.get_status(read_time)[self.feedforward_input]
+        self.last_feedforward = self.Kff * total
+        return self.last_feedforward
+
+    def get_type(self):
+        return "feedforward"
+
+    def get_status(self, eventtime):
+        status = super().get_status(eventtime)
+        status["feedforward"] = round(self.last_feedforward * PID_PARAM_BASE, 3)
+        return status
+
+
+TEMPLATE_ERROR_LOG_INTERVAL = 60.0
+
+
+class ControlTemplate:
+    @staticmethod
+    def init_profile(config_section, name, pmgr):
+        temp_profile = {}
+        for key, (
+            type,
+            placeholder,
+            default,
+            can_be_none,
+        ) in TEMPLATE_PROFILE_OPTIONS.items():
+            minval, maxval = QUANTISER_LIMITS.get(key, (None, None))
+            if key == "template_min_interval":
+                minval = 0.0
+            temp_profile[key] = pmgr._check_value_config(
+                key,
+                config_section,
+                type,
+                can_be_none,
+                default=default,
+                minval=minval,
+                maxval=maxval,
+            )
+        if name != "default":
+            profile_version = config_section.getint("profile_version", 0)
+            if SERVO_PROFILE_VERSION != profile_version:
+                logging.info(
+                    "servo_profile: Profile [%s] not compatible with this version\n"
+                    "of servo_profile. Profile Version: %d Current Version: %d "
+                    % (name, profile_version, SERVO_PROFILE_VERSION)
+                )
+                return None
+        return temp_profile
+
+    @staticmethod
+    def set_values(pmgr, gcmd, control, profile_name):
+        current_profile = pmgr.get_active_control().get_profile()
+        template = pmgr._check_value_gcmd("TEMPLATE", None, gcmd, str, False)
+        template_inputs = pmgr._check_value_gcmd(
+            "TEMPLATE_INPUTS", None, gcmd, str, True
+        )
+        template_min_interval = pmgr._check_value_gcmd(
+            "TEMPLATE_MIN_INTERVAL", 0.0, gcmd, float, False, minval=0.0
+        )
+        min_percent = pmgr._check_value_gcmd(
+            "MIN_PERCENT", current_profile["min_percent"], gcmd, float, True
+        )
+        max_percent = pmgr._check_value_gcmd(
+            "MAX_PERCENT", current_profile["max_percent"], gcmd, float, True
+        )
+        temp_profile = {
+            "name": profile_name,
+            "control": control,
+            "template": template,
+            "template_inputs": template_inputs,
+            "template_min_interval": template_min_interval,
+            "min_percent": min_percent,
+            "max_percent": max_percent,
+        }
+        temp_profile.update(FlapQuantiser.set_values(pmgr, gcmd, current_profile))
+        temp_control = pmgr.servo.lookup_control(temp_profile)
+        pmgr.servo.set_control(temp_control)
+        msg = (
+            "Template Parameters:\n"
+            "Control: %s\n"
+            "Template: %s\n"
+            "Template Inputs: %s\n"
+            "Template Min Interval: %.3f\n"
+            "Min Percent: %.3f\n"
+            "Max Percent: %.3f\n"
+            % (
+                control,
+                template,
+                template_inputs,
+                template_min_interval,
+                min_percent,
+                max_percent,
+            )
+        )
+        msg += FlapQuantiser.load_console_message(temp_profile)
+        msg += "have been set as current profile."
+        pmgr.servo.gcode.respond_info(msg)
+
+    @staticmethod
+    def save_profile(pmgr, temp_profile, profile_name=None, verbose=True):
+        if profile_name is None:
+            profile_name = temp_profile["name"]
+        section_name = pmgr._compute_section_name(profile_name)
+        pmgr.servo.configfile.set(
+            section_name, "profile_version", SERVO_PROFILE_VERSION
+        )
+        for key, (
+            type,
+            placeholder,
+            default,
+            can_be_none,
+        ) in TEMPLATE_PROFILE_OPTIONS.items():
+            value = temp_profile[key]
+            if value is not None:
+                pmgr.servo.configfile.set(
+                    section_name, key, pmgr._format_value(placeholder, value)
+                )
+        temp_profile["name"] = profile_name
+        pmgr.profiles[profile_name] = temp_profile
+        if verbose:
+            pmgr.servo.gcode.respond_info(
+                "Current Servo profile for servo [%s] "
+                "has been saved to profile [%s] "
+                "for the current session. The SAVE_CONFIG command will\n"
+                "update the printer config file and restart the printer."
+                % (pmgr.servo.name, profile_name)
+            )
+
+    @staticmethod
+    def load_console_message(profile, servo):
+        msg = "Control: %s\n" % (profile["control"],)
+        msg += "Template: %s\n" % profile["template"]
+        if profile["template_inputs"] is not None:
+            msg += "Template Inputs: %s\n" % profile["template_inputs"]
+        msg += "Template Min Interval: %.3f\n" % profile["template_min_interval"]
+        msg += "Min Percent: %.3f\n" % profile["min_percent"]
+        msg += "Max Percent: %.3f\n" % profile["max_percent"]
+        msg += FlapQuantiser.load_console_message(profile)
+        return msg
+
+    def __init__(self, profile, servo):
+        self.profile = profile
+        self.servo = servo
+        self.quantiser = FlapQuantiser(profile, servo)
+        self.printer = servo.printer
+        self.min_percent = profile["min_percent"]
+        self.max_percent = profile["max_percent"]
+        self.min_interval = profile["template_min_interval"]
+        self.inputs = []
+        if profile["template_inputs"] is not None:
+            self.inputs = [
+                i.strip() for i in profile["template_inputs"].split(",") if i.strip()
+            ]
+        # Compile once, the context is reused for every evaluation
+        gcode_macro = self.printer.load_object(servo.config, "gcode_macro")
+        self.template = TemplateWrapper(
+            self.printer,
+            gcode_macro.env,
+            "nevermore_servo_profile %s %s" % (servo.name, profile.get("name")),
+            profile["template"],
+        )
+        self.context = gcode_macro.create_template_context()
+        self.reactor = servo.reactor
+        self.last_inputs = None
+        self.last_render_time = None
+        self.render_pending = False
+        self.last_error_time = None
+        self.suppressed_errors = 0
+        self.percent = None
+
+    def _read_inputs(self, eventtime, temp, target_temp):
+        values = []
+        for name in self.inputs:
+            if name == "temperature":
+                values.append(temp)
+            elif name == "target":
+                values.append(target_temp)
+            else:
+                obj_name, _, field = name.rpartition(".")
+                obj = self.printer.lookup_object(obj_name, None)
+                if obj is None or not hasattr(obj, "get_status"):
+                    values.append(None)
+                else:
+                    values.append(obj.get_status(eventtime).get(field))
+        return tuple(values)
+
+    def angle_update(self, read_time, temp, target_temp):
+        # Rendering touches printer objects and may be slow, so it runs in the
+        # reactor and the result is picked up with the next sample
+        if not self.render_pending and (
+            self.last_render_time is None
+            or read_time - self.last_render_time >= self.min_interval
+        ):
+            self.render_pending = True
+            self.last_render_time = read_time
+            self.reactor.register_async_callback(
+                lambda eventtime: self._render(eventtime, temp, target_temp)
+            )
+        if self.percent is None:
+            return self.servo.last_percent
+        return self.percent
+
+    def _render(self, eventtime, temp, target_temp):
+        self.render_pending = False
+        inputs = self._read_inputs(eventtime, temp, target_temp)
+        if self.percent is not None and self.inputs and inputs == self.last_inputs:
+            return
+        context = self.context
+        context["printer"] = GetStatusWrapper(self.printer, eventtime)
+        context["temperature"] = temp
+        context["target"] = target_temp
+        context["percent"] = self.servo.last_percent
+        try:
+            # TemplateWrapper.render() logs every failure itself, the compiled
+            # template is rendered directly so the errors can be rate limited
+            value = float(self.template.template.render(context))
+        except Exception:
+            self._log_error(eventtime)
+            return
+        self.last_inputs = inputs
+        self.percent = max(self.min_percent, min(self.max_percent, value))
+
+    def _log_error(self, eventtime):
+        # A broken template fails on every sample, log it once a while
+        if (
+            self.last_error_time is not None
+            and eventtime - self.last_error_time < TEMPLATE_ERROR_LOG_INTERVAL
+        ):
+            self.suppressed_errors += 1
+            return
+        logging.exception(
+            "nevermore_servo: [%s] template evaluation failed "
+            "(%d failures suppressed)",
+            self.servo.name,
+            self.suppressed_errors,
+        )
+        self.last_error_time = eventtime
+        self.suppressed_errors = 0
+
+    def check_busy(self, eventtime, smoothed_temp, target_temp):
+        return False
+
+    def get_state(self):
+        return {}
+
+    def set_state(self, state):
+        pass
+
+    def set_name(self, name):
+        self.profile["name"] = name
+
+    def _load_console_message(self):
+        return ControlTemplate.load_console_message(self.profile, self.servo)
+
+    def get_profile(self):
+        return self.profile
+
+    def get_type(self):
+        return "template"
+
+
+MPC_LEVELS = 11
+# Observer time constant relative to mpc_time_constant
+MPC_OBSERVER_RATIO = 0.25
+
+
+class ControlMPC(ControlPID):
+    PROFILE_OPTIONS = MPC_PROFILE_OPTIONS
+    LIMITS = MPC_LIMITS
+
+    @classmethod
+    def _set_extra_values(cls, pmgr, gcmd, temp_profile):
+        plant_gain = pmgr._check_value_gcmd(
+            "MPC_PLANT_GAIN", None, gcmd, float, False
+        )
+        time_constant = pmgr._check_value_gcmd(
+            "MPC_TIME_CONSTANT",
+            None,
+            gcmd,
+            float,
+            False,
+            **cls._limits("mpc_time_constant"),
+        )
+        horizon = pmgr._check_value_gcmd(
+            "MPC_HORIZON", 300.0, gcmd, float, False, **cls._limits("mpc_horizon")
+        )
+        steps = pmgr._check_value_gcmd(
+            "MPC_STEPS", 10, gcmd, int, False, **cls._limits("mpc_steps")
+        )
+        penalty = pmgr._check_value_gcmd(
+            "MPC_ACTUATION_PENALTY",
+            1.0,
+            gcmd,
+            float,
+            False,
+            **cls._limits("mpc_actuation_penalty"),
+        )
+        timeout = pmgr._check_value_gcmd(
+            "MPC_TIMEOUT", 30.0, gcmd, float, False, **cls._limits("mpc_timeout")
+        )
+        temp_profile["mpc_plant_gain"] = plant_gain
+        temp_profile["mpc_time_constant"] = time_constant
+        temp_profile["mpc_horizon"] = horizon
+        temp_profile["mpc_steps"] = steps
+        temp_profile["mpc_actuation_penalty"] = penalty
+        temp_profile["mpc_timeout"] = timeout
+        return (
+            "MPC: plant_gain=%.4f time_constant=%.2f horizon=%.1f steps=%d "
+            "actuation_penalty=%.4f timeout=%.1f\n"
+            % (plant_gain, time_constant, horizon, steps, penalty, timeout)
+        )
+
+    @classmethod
+    def load_console_message(cls, profile, servo):
+        msg = super().load_console_message(profile, servo)
+        msg += (
+            "MPC: plant_gain=%.4f time_constant=%.2f horizon=%.1f steps=%d "
+            "actuation_penalty=%.4f timeout=%.1f\n"
+            % (
+                profile["mpc_plant_gain"],
+                profile["mpc_time_constant"],
+                profile["mpc_horizon"],
+                profile["mpc_steps"],
+                profile["mpc_actuation_penalty"],
+                profile["mpc_timeout"],
+            )
+        )
+        return msg
+
+    def __init__(self, profile, servo):
+        super().__init__(profile, servo)
+        self.plant_gain = profile["mpc_plant_gain"]
+        self.time_constant = profile["mpc_time_constant"]
+        self.horizon = profile["mpc_horizon"]
+        self.steps = profile["mpc_steps"]
+        self.actuation_penalty = profile["mpc_actuation_penalty"]
+        self.timeout = profile["mpc_timeout"]
+        span = self.max_percent - self.min_percent
+        self.levels = [
+            self.min_percent + span * i / (MPC_LEVELS - 1) for i in range(MPC_LEVELS)
+        ]
+        self.observer = ChamberObserver(
+            self.plant_gain, self.time_constant, MPC_OBSERVER_RATIO
+        )
+        self.plan = None
+        self.fallback = True
+        self.solver_lock = threading.Condition()
+        self.request = None
+        self.solver_thread = None
+        self.running = False
+
+    def angle_update(self, read_time, temp, target_temp):
+        # The PID keeps running so falling back to it is bumpless
+        pid_percent = super().angle_update(read_time, temp, target_temp)
+        percent = self.servo.last_percent
+        self.observer.update(read_time, temp, percent)
+        self._submit(
+            (
+                read_time,
+                self.observer.temp,
+                self.observer.ambient,
+                target_temp,
+                percent,
+            )
+        )
+        plan = self.plan
+        if plan is None or read_time - plan[0] > self.timeout:
+            self.fallback = True
+            return pid_percent
+        self.fallback = False
+        plan_time, first, second, switch_time = plan
+        return first if read_time < plan_time + switch_time else second
+
+    def _submit(self, request):
+        with self.solver_lock:
+            self.request = request
+            if self.solver_thread is None or not self.solver_thread.is_alive():
+                self.running = True
+                self.solver_thread = threading.Thread(
+                    target=self._solver_loop,
+                    name="nevermore_servo_mpc %s" % (self.servo.name,),
+                )
+                self.solver_thread.daemon = True
+                self.solver_thread.start()
+            self.solver_lock.notify()
+
+    def stop(self):
+        with self.solver_lock:
+            self.running = False
+            self.solver_lock.notify()
+
+    def _solver_loop(self):
+        reactor = self.servo.reactor
+        while True:
+            with self.solver_lock:
+                while self.request is None and self.running:
+                    self.solver_lock.wait()
+                if not self.running:
+                    return
+                request = self.request
+                self.request = None
+            try:
+                plan = self._solve(request)
+            except Exception:
+                logging.exception(
+                    "nevermore_servo: [%s] MPC solve failed", self.servo.name
+                )
+                continue
+            reactor.register_async_callback(
+                lambda eventtime, plan=plan: self._apply_plan(plan)
+            )
+
+    def _apply_plan(self, plan):
+        if self.running:
+            self.plan = plan
+
+    def _solve(self, request):
+        # Try all two-block flap trajectories over the horizon
+        read_time, temp, ambient, target_temp, percent = request
+        gain = self.plant_gain
+        tau = self.time_constant
+        step_time = self.horizon / self.steps
+        decay = math.exp(-step_time / tau)
+        switch_step = self.steps // 2
+        best = None
+        for first in self.levels:
+            first_temp = temp
+            first_cost = self.actuation_penalty * abs(first - percent)
+            for k in range(switch_step):
+                first_temp = decay * first_temp + (1.0 - decay) * (
+                    ambient + gain * first
+                )
+                first_cost += (first_temp - target_temp) ** 2
+            for second in self.levels:
+                t = first_temp
+                cost = first_cost + self.actuation_penalty * abs(second - first)
+                for k in range(switch_step, self.steps):
+                    t = decay * t + (1.0 - decay) * (ambient + gain * second)
+                    cost += (t - target_temp) ** 2
+                if best is None or cost < best[0]:
+                    best = (cost, first, second)
+        return read_time, best[1], best[2], switch_step * step_time
+
+    def get_type(self):
+        return "mpc"
+
+    def get_status(self, eventtime):
+        status = super().get_status(eventtime)
+        plan = self.plan
+        status["mpc"] = {
+            "plan": None if plan is None else [plan[1], plan[2]],
+            "fallback": self.fallback,
+        }
+        return status
+
+
+class ChamberObserver:
+    # Estimates the chamber temperature and the steady state it settles to
+    # with a closed flap from the prediction error of the first order model.
+    # Disturbances like ambient changes are folded into the steady state.
+    def __init__(self, gain, time_constant, ratio):
+        self.gain = gain
+        self.time_constant = time_constant
+        self.observer_time = time_constant * ratio
+        self.temp = None
+        self.ambient = None
+        self.prev_time = None
+
+    def update(self, read_time, temp, percent):
+        if self.temp is None:
+            self.temp = temp
+            self.ambient = temp - self.gain * percent
+            self.prev_time = read_time
+            return
+        time_diff = read_time - self.prev_time
+        if time_diff <= 0.0:
+            return
+        self.prev_time = read_time
+        decay = math.exp(-time_diff / self.time_constant)
+        pole = math.exp(-time_diff / self.observer_time)
+        # Both observer poles are placed at 'pole'
+        l_temp = 1.0 - pole * pole / decay
+        l_ambient = (1.0 - pole) ** 2 / (1.0 - decay)
+        predicted = decay * self.temp + (1.0 - decay) * (
+            self.ambient + self.gain * percent
+        )
+        err = temp - predicted
+        self.temp = predicted + l_temp * err
+        self.ambient += l_ambient * err
+
+
+ADAPTIVE_WARMUP = 60
+ADAPTIVE_BLOCK_TIME = 30.0
+ADAPTIVE_INITIAL_COVARIANCE = 1000.0
+ADAPTIVE_MAX_COVARIANCE = 1.0e6
+# Covariance of the model coefficients below which the excitation has been
+# seen long enough for the estimate to be trusted
+ADAPTIVE_TRUST_COVARIANCE = 1.0
+# Half period of the excitation square wave, a multiple of the block time
+ADAPTIVE_EXCITATION_TIME = 300.0
+
+
+class ThermalEstimator:
+    # Recursive fit of
+    #   T[k] = a * T[k-1] + b0 * percent[k] + b1 * percent[k-1] + c
+    # over block averages, percent being the mean flap position during a
+    # block. A flap move acts on the average of its own and the next block.
+    # Blocks start at multiples of ADAPTIVE_BLOCK_TIME, like the excitation
+    # steps, a block mixing both excitation levels does not fit the model.
+    #
+    # The controller moves the flap with the sensor noise and the chamber
+    # temperature, so plain least squares is biased towards a weak, fast
+    # chamber. The excitation and T[k-2] are used as instrumental variables
+    # instead, neither depends on the noise in T[k].
+    def __init__(self, forgetting):
+        self.forgetting = forgetting
+        self.theta = [1.0, 0.0, 0.0, 0.0]
+        self.P = [
+            [ADAPTIVE_INITIAL_COVARIANCE if i == j else 0.0 for j in range(4)]
+            for i in range(4)
+        ]
+        self.history = collections.deque(maxlen=2)
+        self.sample_time = 0.0
+        self.samples = 0
+        self.block_index = None
+        self.block_time = 0.0
+        self.block_temp = 0.0
+        self.block_percent = 0.0
+        self.block_excitation = 0.0
+
+    def update(self, start_time, time_diff, temp, percent, excitation):
+        # Single samples are too noisy compared to the change between them,
+        # fitting them would bias the estimate towards a fast chamber. The
+        # percent and excitation were applied from start_time until temp
+        # was read.
+        if time_diff <= 0.0:
+            return
+        block_index = start_time // ADAPTIVE_BLOCK_TIME
+        if block_index != self.block_index:
+            if self.block_time:
+                self._close_block()
+            if self.block_index is not None and block_index != self.block_index + 1:
+                # A gap in the samples, the blocks before it are no history
+                self.history.clear()
+            self.block_index = block_index
+        self.block_time += time_diff
+        self.block_temp += temp * time_diff
+        self.block_percent += percent * time_diff
+        self.block_excitation += excitation * time_diff
+
+    def _close_block(self):
+        time_diff = self.block_time
+        block = (
+            self.block_temp / time_diff,
+            self.block_percent / time_diff,
+            self.block_excitation / time_diff,
+        )
+        self.block_time = self.block_temp = 0.0
+        self.block_percent = self.block_excitation = 0.0
+        history = self.history
+        if len(history) == 2:
+            (temp_2, _, _), (temp_1, percent_1, excitation_1) = history
+            temp, percent, excitation = block
+            self._update(
+                (temp_1, percent, percent_1, 1.0),
+                (temp_2, excitation, excitation_1, 1.0),
+                temp,
+                time_diff,
+            )
+        history.append(block)
+
+    def _update(self, phi, z, temp, time_diff):
+        P = self.P
+        p_z = [sum(P[i][j] * z[j] for j in range(4)) for i in range(4)]
+        phi_p = [sum(phi[i] * P[i][j] for i in range(4)) for j in range(4)]
+        denom = self.forgetting + sum(phi[i] * p_z[i] for i in range(4))
+        k = [p / denom for p in p_z]
+        err = temp - sum(self.theta[i] * phi[i] for i in range(4))
+        self.theta = [self.theta[i] + k[i] * err for i in range(4)]
+        # Stop forgetting once the covariance grows without excitation
+        forgetting = self.forgetting
+        if sum(P[i][i] for i in range(4)) > ADAPTIVE_MAX_COVARIANCE:
+            forgetting = 1.0
+        self.P = [
+            [(P[i][j] - k[i] * phi_p[j]) / forgetting for j in range(4)]
+            for i in range(4)
+        ]
+        if self.samples:
+            self.sample_time += (time_diff - self.sample_time) * (1.0 - self.forgetting)
+        else:
+            self.sample_time = time_diff
+        self.samples += 1
+
+    def get_model(self):
+        a, b0, b1, c = self.theta
+        if self.samples < ADAPTIVE_WARMUP or not 0.0 < a < 1.0 or not b0 + b1:
+            return None
+        return (b0 + b1) / (1.0 - a), -self.sample_time / math.log(a)
+
+    def get_uncertainty(self):
+        # Of the temperature coefficient and of the summed flap coefficients,
+        # it only shrinks with excitation, the offset just carries the
+        # ambient temperature
+        P = self.P
+        return P[0][0] + P[1][1] + P[2][2] + P[1][2] + P[2][1]
+
 
 def load_config_prefix(config):
     return NevermoreServo(config)
@@ -59,12 +59,15 @@ class ProfileManager:
         default=None,
         above=None,
         minval=None,
+        maxval=None,
     ):
         if type is int:
-            value = config_section.getint(key, default=default, minval=minval)
+            value = config_section.getint(
+                key, default=default, minval=minval, maxval=maxval
+            )
         elif type is float:
             value = config_section.getfloat(
-                key, default=default, minval=minval, above=above
+                key, default=default, minval=minval, maxval=maxval, above=above
             )
         elif type is bool:
             value = config_section.getboolean(key, default=default)
@@ -101,17 +104,32 @@ class ProfileManager:
         can_be_none,
         minval=None,
         maxval=None,
+        above=None,
     ):
         if type is int:
             value = gcmd.get_int(name, default, minval=minval, maxval=maxval)
         elif type is float:
-            value = gcmd.get_float(name, default, minval=minval, maxval=maxval)
+            value = gcmd.get_float(
+                name, default, minval=minval, maxval=maxval, above=above
+            )
         elif type is bool:
             value = gcmd.get(name, default)
             if value is not None:
                 value = value.lower() in STR_TO_BOOL
             else:
                 value = False
+        elif type == "floatlist":
+            value = gcmd.get(name, None)
+            if value is None:
+                value = default
+            else:
+                try:
+                    value = [float(v) for v in value.split(",") if v.strip()]
+                except ValueError:
+                    raise gcmd.error(
+                        "nevermore_servo_profile: '%s' has to be a comma "
+                        "separated list of numbers." % name
+                    )
         else:
             value = gcmd.get(name, default)
         if not can_be_none and value is None:
@@ -120,6 +138,11 @@ class ProfileManager:
             )
         return value.lower() if type == "lower" else value
 
+    def _format_value(self, placeholder, value):
+        if isinstance(value, (list, tuple)):
+            return ", ".join(placeholder % v for v in value)
+        return placeholder % value
+
     def _compute_section_name(self, profile_name):
         return (
             self.servo.name
@@ -130,8 +153,15 @@ class ProfileManager:
     def init_default_profile(self):
         return self._init_profile(self.servo.config, "default")
 
+    def get_active_control(self):
+        # In manual mode the last automatic control is still the reference
+        control = self.servo.get_control()
+        if control is None:
+            control = self.cached_control
+        return control
+
     def set_values(self, profile_name, gcmd, verbose=True):
-        current_profile = self.servo.get_control().get_profile()
+        current_profile = self.get_active_control().get_profile()
         control = self._check_value_gcmd(
             "CONTROL", current_profile["control"], gcmd, "lower", True
         )
@@ -145,7 +175,7 @@ class ProfileManager:
             self.save_profile(profile_name=profile_name, verbose=verbose)
 
     def save_profile(self, profile_name=None, gcmd=None, verbose=True):
-        temp_profile = self.servo.get_control().get_profile()
+        temp_profile = self.get_active_control().get_profile()
         self.control_types[temp_profile["control"]].save_profile(
             pmgr=self,
             temp_profile=temp_profile,
@@ -153,11 +183,15 @@ class ProfileManager:
             verbose=verbose,
         )
         if profile_name is not None:
-            self.servo.get_control().set_name(profile_name)
+            self.get_active_control().set_name(profile_name)
 
     def load_profile(self, profile_name, gcmd):
         verbose = self._check_value_gcmd("VERBOSE", "low", gcmd, "lower", True)
-        if profile_name == self.servo.get_control().get_profile()["name"]:
+        current_control = self.servo.get_control()
+        if (
+            current_control is not None
+            and profile_name == current_control.get_profile()["name"]
+        ):
             if verbose == "high" or verbose == "low":
                 self.servo.gcode.respond_info(
                     "Heater Profile [%s] already loaded for heater [%s]."
@@ -219,8 +253,10 @@ class ProfileManager:
 
     def use_manual(self, profile_name, gcmd=None):
         if profile_name.lower() in STR_TO_BOOL:
-            self.cached_control = self.servo.set_control(None)
-        else:
+            control = self.servo.set_control(None)
+            if control is not None:
+                self.cached_control = control
+        elif self.servo.get_control() is None:
             self.servo.set_control(self.cached_control)
 
     cmd_NEVERMORE_SERVO_PROFILE_help = (
@@ -0,0 +1,129 @@
+# Nevermore Controller Servo Runtime State Persistence
+#
+# Copyright (C) 2025       Vinzenz Hassert
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import json
+import logging
+import os
+import threading
+import time
+
+STATE_VERSION = 1
+
+
+class StateStore:
+    def __init__(self, servo, filename, save_interval, max_age):
+        self.servo = servo
+        self.reactor = servo.reactor
+        self.filename = filename
+        self.save_interval = save_interval
+        self.max_age = max_age
+        self.cond = threading.Condition()
+        self.pending = None
+        self.write_lock = threading.Lock()
+        self.sequence = 0
+        self.last_written = 0
+        self.writer_thread = None
+        self.stopping = False
+        self.save_timer = self.reactor.register_timer(self._save_callback_timer)
+        servo.printer.register_event_handler("klippy:ready", self._handle_ready)
+        servo.printer.register_event_handler(
+            "klippy:disconnect", self._handle_disconnect
+        )
+
+    def _handle_ready(self):
+        self.stopping = False
+        self.writer_thread = threading.Thread(
+            target=self._writer_loop,
+            name="nevermore_servo_state %s" % (self.servo.name,),
+        )
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+        self.reactor.update_timer(
+            self.save_timer, self.reactor.monotonic() + self.save_interval
+        )
+
+    def _handle_disconnect(self):
+        # Write the final state synchronously, the process may exit right after
+        self.reactor.update_timer(self.save_timer, self.reactor.NEVER)
+        with self.cond:
+            self.pending = None
+        self._write(*self._snapshot())
+        # Klipper restarts within the same process, a left over thread would
+        # keep the old printer objects alive
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+            self.writer_thread = None
+
+    def _save_callback_timer(self, eventtime):
+        with self.cond:
+            self.pending = self._snapshot()
+            self.cond.notify()
+        return eventtime + self.save_interval
+
+    def _snapshot(self):
+        state = self.servo.get_runtime_state()
+        state["version"] = STATE_VERSION
+        state["name"] = self.servo.name
+        state["saved_at"] = time.time()
+        self.sequence += 1
+        return self.sequence, state
+
+    def _writer_loop(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                sequence, state = self.pending
+                self.pending = None
+            self._write(sequence, state)
+
+    def _write(self, sequence, state):
+        # The writer thread and the final write on disconnect share the file
+        with self.write_lock:
+            if sequence <= self.last_written:
+                # A newer snapshot is already on disk
+                return
+            temp_name = self.filename + ".tmp"
+            try:
+                with open(temp_name, "w") as f:
+                    json.dump(state, f)
+                os.replace(temp_name, self.filename)
+            except (IOError, OSError, TypeError, ValueError):
+                logging.exception(
+                    "nevermore_servo: [%s] could not write state file '%s'",
+                    self.servo.name,
+                    self.filename,
+                )
+                return
+            self.last_written = sequence
+
+    def load(self):
+        try:
+            with open(self.filename, "r") as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if (
+            not isinstance(state, dict)
+            or state.get("version") != STATE_VERSION
+            or state.get("name") != self.servo.name
+        ):
+            return None
+        # Old states only keep their long term counters
+        age = time.time() - state.get("saved_at", 0.0)
+        state["recent"] = 0.0 <= age <= self.max_age
+        if not state["recent"]:
+            logging.info(
+                "nevermore_servo: [%s] ignoring controller state saved %.0fs ago",
+                self.servo.name,
+                age,
+            )
+        return state
@@ -0,0 +1,377 @@
+# Nevermore Controller Servo Offline Gain Search
+#
+# Copyright (C) 2025       Vinzenz Hassert
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import importlib
+import logging
+import math
+import multiprocessing
+import traceback
+
+MAX_DEAD_TIME = 300.0
+SMOOTH_TIME_CANDIDATES = (1.0, 2.0, 5.0, 10.0)
+GAIN_SPREAD = 4.0
+SETTLE_BAND = 1.0
+
+
+class PlantModel:
+    # First-order-plus-dead-time chamber model:
+    #   tau * dT/dt = ambient + gain * percent(t - dead_time) - T
+    def __init__(self, gain, time_constant, dead_time, ambient, sample_time):
+        self.gain = gain
+        self.time_constant = time_constant
+        self.dead_time = dead_time
+        self.ambient = ambient
+        self.sample_time = sample_time
+
+
+def load_trace(np, filename):
+    # Lines are "<time>,<temperature>,<percent>", anything else is skipped
+    rows = []
+    with open(filename, "r") as f:
+        for line in f:
+            parts = line.strip().split(",")
+            if len(parts) < 3:
+                continue
+            try:
+                rows.append([float(p) for p in parts[:3]])
+            except ValueError:
+                continue
+    if len(rows) < 10:
+        raise ValueError("Trace '%s' contains less than 10 samples" % (filename,))
+    data = np.array(rows)
+    data = data[np.argsort(data[:, 0], kind="stable")]
+    return data[:, 0], data[:, 1], data[:, 2]
+
+
+def fit_plant(np, times, temps, percents):
+    sample_time = float(np.median(np.diff(times)))
+    if sample_time <= 0.0:
+        raise ValueError("Trace timestamps must be increasing")
+    grid = np.arange(times[0], times[-1], sample_time)
+    temp = np.interp(grid, times, temps)
+    # The flap holds its position between commands
+    idx = np.searchsorted(times, grid, side="right") - 1
+    flap = percents[np.clip(idx, 0, len(percents) - 1)]
+    count = len(grid)
+    max_delay = min(int(MAX_DEAD_TIME / sample_time), count // 4)
+    best = None
+    for delay in range(max_delay + 1):
+        # T[k+1] = a * T[k] + b * u[k - delay] + c
+        y = temp[delay + 1 :]
+        x = np.column_stack(
+            (temp[delay:-1], flap[: count - delay - 1], np.ones(len(y)))
+        )
+        coeffs = np.linalg.lstsq(x, y, rcond=None)[0]
+        a, b, c = coeffs
+        if not 0.0 < a < 1.0:
+            continue
+        mse = float(np.mean((y - x.dot(coeffs)) ** 2))
+        if best is None or mse < best[0]:
+            best = (mse, delay, a, b, c)
+    if best is None:
+        raise ValueError(
+            "Could not fit a plant model, the trace needs flap movements "
+            "with a visible temperature response"
+        )
+    mse, delay, a, b, c = best
+    return PlantModel(
+        gain=float(b / (1.0 - a)),
+        time_constant=float(-sample_time / math.log(a)),
+        dead_time=delay * sample_time,
+        ambient=float(c / (1.0 - a)),
+        sample_time=sample_time,
+    )
+
+
+def candidate_grid(np, model, grid_size, pid_param_base):
+    # Centre the grid on an IMC tuning of the fitted model
+    tau = model.time_constant
+    theta = max(model.dead_time, model.sample_time)
+    lam = max(0.5 * tau, theta)
+    kc = (tau + 0.5 * theta) / (max(abs(model.gain), 1e-6) * (lam + 0.5 * theta))
+    ti = tau + 0.5 * theta
+    td = tau * theta / (2.0 * tau + theta)
+    kp = kc * pid_param_base
+    factors = np.geomspace(1.0 / GAIN_SPREAD, GAIN_SPREAD, grid_size)
+    kps, kis, kds, smooth_times = np.meshgrid(
+        kp * factors,
+        kp / ti * factors,
+        kp * td * factors,
+        np.array(SMOOTH_TIME_CANDIDATES),
+        indexing="ij",
+    )
+    return kps.ravel(), kis.ravel(), kds.ravel(), smooth_times.ravel()
+
+
+def simulate(
+    np,
+    model,
+    kps,
+    kis,
+    kds,
+    smooth_times,
+    target,
+    duration,
+    reverse,
+    min_percent,
+    max_percent,
+    update_tolerance,
+    pid_param_base,
+):
+    # Batched equivalent of ControlPID.angle_update driving the plant model
+    dt = model.sample_time
+    steps = int(duration / dt)
+    delay = int(round(model.dead_time / dt))
+    kp = kps / pid_param_base
+    ki = kis / pid_param_base
+    kd = kds / pid_param_base
+    integ_max = np.where(ki > 0.0, max_percent / np.where(ki > 0.0, ki, 1.0), 0.0)
+    decay = math.exp(-dt / model.time_constant)
+    start_temp = model.ambient
+    direction = 1.0 if start_temp <= target else -1.0
+    temp = np.full(len(kp), start_temp)
+    prev_temp = temp.copy()
+    prev_deriv = np.zeros(len(kp))
+    prev_integ = np.zeros(len(kp))
+    flap = np.zeros(len(kp))
+    history = np.zeros((delay + 1, len(kp)))
+    overshoot = np.zeros(len(kp))
+    settling_time = np.zeros(len(kp))
+    actuations = np.zeros(len(kp), dtype=int)
+    for step in range(steps):
+        temp_diff = temp - prev_temp
+        deriv = np.where(
+            dt >= smooth_times,
+            temp_diff / dt,
+            (prev_deriv * (smooth_times - dt) + temp_diff) / smooth_times,
+        )
+        err = target - temp
+        integ = np.clip(prev_integ + err * dt, 0.0, integ_max)
+        co = kp * err + ki * integ - kd * deriv
+        bounded_co = np.clip(co, 0.0, 1.0)
+        prev_integ = np.where(co == bounded_co, integ, prev_integ)
+        prev_temp = temp
+        prev_deriv = deriv
+        if reverse:
+            bounded_co = 1.0 - bounded_co
+        percent = bounded_co * (max_percent - min_percent) + min_percent
+        moved = np.abs(percent - flap) > update_tolerance
+        flap = np.where(moved, percent, flap)
+        actuations += moved
+        history[step % (delay + 1)] = flap
+        applied = history[(step + 1) % (delay + 1)]
+        temp = decay * temp + (1.0 - decay) * (model.ambient + model.gain * applied)
+        overshoot = np.maximum(overshoot, (temp - target) * direction)
+        settling_time = np.where(
+            np.abs(temp - target) > SETTLE_BAND, (step + 1) * dt, settling_time
+        )
+    return overshoot, settling_time, actuations
+
+
+def rank_candidates(np, overshoot, settling_time, actuations, duration):
+    def ranks(values):
+        return np.argsort(np.argsort(values, kind="stable"), kind="stable")
+
+    score = ranks(overshoot) + ranks(settling_time) + ranks(actuations)
+    unsettled = settling_time >= duration
+    return np.lexsort((score, unsettled))
+
+
+def search(filename, params):
+    np = importlib.import_module("numpy")
+    times, temps, percents = load_trace(np, filename)
+    model = fit_plant(np, times, temps, percents)
+    kps, kis, kds, smooth_times = candidate_grid(
+        np, model, params["grid"], params["pid_param_base"]
+    )
+    overshoot, settling_time, actuations = simulate(
+        np,
+        model,
+        kps,
+        kis,
+        kds,
+        smooth_times,
+        params["target"],
+        params["duration"],
+        params["reverse"],
+        params["min_percent"],
+        params["max_percent"],
+        params["update_tolerance"],
+        params["pid_param_base"],
+    )
+    order = rank_candidates(
+        np, overshoot, settling_time, actuations, params["duration"]
+    )
+    results = []
+    for i in order[: params["count"]]:
+        results.append(
+            {
+                "pid_kp": float(kps[i]),
+                "pid_ki": float(kis[i]),
+                "pid_kd": float(kds[i]),
+                "smooth_time": float(smooth_times[i]),
+                "overshoot": float(max(0.0, overshoot[i])),
+                "settling_time": float(settling_time[i]),
+                "settled": bool(settling_time[i] < params["duration"]),
+                "actuations": int(actuations[i]),
+            }
+        )
+    return model, len(kps), results
+
+
+class ServoTuner:
+    def __init__(self, servo, pid_param_base):
+        self.servo = servo
+        self.pid_param_base = pid_param_base
+        self.printer = servo.printer
+        self.gcode = servo.gcode
+
+    def _background_exec(self, method, args):
+        # Keep the reactor responsive while the search is running
+        import queuelogger
+
+        parent_conn, child_conn = multiprocessing.Pipe()
+
+        def wrapper():
+            queuelogger.clear_bg_logging()
+            try:
+                res = method(*args)
+            except Exception:
+                child_conn.send((True, traceback.format_exc()))
+                child_conn.close()
+                return
+            child_conn.send((False, res))
+            child_conn.close()
+
+        calc_proc = multiprocessing.Process(target=wrapper)
+        calc_proc.daemon = True
+        calc_proc.start()
+        reactor = self.printer.get_reactor()
+        eventtime = last_report_time = reactor.monotonic()
+        while calc_proc.is_alive():
+            if eventtime > last_report_time + 5.0:
+                last_report_time = eventtime
+                self.gcode.respond_info("Searching servo gains...", log=False)
+            eventtime = reactor.pause(eventtime + 0.1)
+        is_err, res = parent_conn.recv()
+        calc_proc.join()
+        parent_conn.close()
+        if is_err:
+            raise self.gcode.error(
+                "nevermore_servo_tuner: Error in gain search: %s" % (res,)
+            )
+        return res
+
+    cmd_NEVERMORE_SERVO_AUTOTUNE_help = (
+        "Search PID gains for a nevermore_servo from a recorded temperature trace"
+    )
+
+    def cmd_NEVERMORE_SERVO_AUTOTUNE(self, gcmd):
+        try:
+            importlib.import_module("numpy")
+        except ImportError:
+            raise gcmd.error(
+                "nevermore_servo_tuner: numpy is required for the gain search, "
+                "install it into the klippy environment."
+            )
+        servo = self.servo
+        filename = gcmd.get("TRACE")
+        profile = servo.pmgr.get_active_control().get_profile()
+        params = {
+            "target": gcmd.get_float(
+                "TARGET",
+                servo.target_temp or servo.target_temp_conf,
+                minval=servo.min_temp,
+                maxval=servo.max_temp,
+            ),
+            "duration": gcmd.get_float("DURATION", 3600.0, above=0.0),
+            "grid": gcmd.get_int("GRID", 10, minval=2, maxval=20),
+            "count": gcmd.get_int("COUNT", 3, minval=1, maxval=10),
+            # Template profiles have no direction, fall back to the defaults
+            "reverse": bool(profile.get("reverse", False)),
+            "min_percent": profile.get("min_percent", 0.0),
+            "max_percent": profile.get("max_percent", 1.0),
+            "update_tolerance": servo.update_tolerance,
+            "pid_param_base": self.pid_param_base,
+        }
+        prefix = gcmd.get("PREFIX", "autotune")
+        model, candidates, results = self._background_exec(search, (filename, params))
+        logging.info(
+            "nevermore_servo_tuner: [%s] gain=%.4f tau=%.2f dead_time=%.2f "
+            "ambient=%.2f",
+            servo.name,
+            model.gain,
+            model.time_constant,
+            model.dead_time,
+            model.ambient,
+        )
+        msg = (
+            "Fitted plant: gain=%.3f time_constant=%.1fs dead_time=%.1fs "
+            "ambient=%.2f\n"
+            "Simulated %d candidates over %.0fs\n"
+            % (
+                model.gain,
+                model.time_constant,
+                model.dead_time,
+                model.ambient,
+                candidates,
+                params["duration"],
+            )
+        )
+        if not results[0]["settled"]:
+            msg += (
+                "Warning: no candidate settled within %.1f degrees, "
+                "check REVERSE of the current profile.\n" % (SETTLE_BAND,)
+            )
+        for i, result in enumerate(results):
+            profile_name = "%s_%d" % (prefix, i + 1)
+            temp_profile = {
+                "name": profile_name,
+                "control": "pid",
+                "smooth_time": result["smooth_time"],
+                "smoothing_elements": None,
+                "pid_kp": result["pid_kp"],
+                "pid_ki": result["pid_ki"],
+                "pid_kd": result["pid_kd"],
+                "reverse": params["reverse"],
+                "min_percent": params["min_percent"],
+                "max_percent": params["max_percent"],
+                "adaptive": False,
+                "adaptive_forgetting": None,
+                "adaptive_limit": None,
+                "adaptive_excitation": None,
+                "adaptive_nominal_gain": None,
+                "adaptive_nominal_time_constant": None,
+                "flap_positions": profile.get("flap_positions"),
+                "open_tolerance": profile.get("open_tolerance"),
+                "close_tolerance": profile.get("close_tolerance"),
+                "dwell_time": profile.get("dwell_time"),
+            }
+            servo.control_types["pid"].save_profile(
+                pmgr=servo.pmgr,
+                temp_profile=temp_profile,
+                profile_name=profile_name,
+                verbose=False,
+            )
+            msg += (
+                "[%s] pid_Kp=%.3f pid_Ki=%.3f pid_Kd=%.3f smooth_time=%.1f "
+                "overshoot=%.2f settling_time=%.0fs actuations=%d\n"
+                % (
+                    profile_name,
+                    result["pid_kp"],
+                    result["pid_ki"],
+                    result["pid_kd"],
+                    result["smooth_time"],
+                    result["overshoot"],
+                    result["settling_time"],
+                    result["actuations"],
+                )
+            )
+        msg += (
+            "The profiles have been saved for the current session. The SAVE_CONFIG "
+            "command will\nupdate the printer config file and restart the printer."
+        )
+        gcmd.respond_info(msg)
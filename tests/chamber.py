@@ -0,0 +1,47 @@
+# Deterministic chamber model driving the sensor callback
+#
+# Copyright (C) 2025       Vinzenz Hassert
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import math
+import random
+
+
+class Chamber:
+    # First order chamber, an open flap cools it towards ambient:
+    #   tau * dT/dt = ambient + heat * (1 - percent) - T
+    def __init__(self, temp=30.0, ambient=25.0, heat=30.0, tau=600.0, seed=0):
+        self.temp = temp
+        self.ambient = ambient
+        self.heat = heat
+        self.tau = tau
+        self.rng = random.Random(seed)
+
+    def step(self, time_diff, percent):
+        decay = math.exp(-time_diff / self.tau)
+        steady = self.ambient + self.heat * (1.0 - percent)
+        self.temp = decay * self.temp + (1.0 - decay) * steady
+        return self.temp
+
+    def read(self, noise):
+        return self.temp + self.rng.gauss(0.0, noise)
+
+
+def run(servo, chamber, start, duration, interval=1.0, noise=0.05, fault=None):
+    # Feed samples through the sensor callback, fault(time, temp) may replace
+    # a reading; returns the time of the last sample
+    callback = servo.sensor.callback
+    reactor = servo.reactor
+    read_time = start
+    steps = int(duration / interval)
+    for i in range(steps):
+        read_time = start + i * interval
+        reactor.now = read_time
+        chamber.step(interval, servo.last_percent)
+        temp = chamber.read(noise)
+        if fault is not None:
+            temp = fault(read_time, temp)
+        callback(read_time, temp)
+        reactor.run_async_callbacks()
+    return read_time
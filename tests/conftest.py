@@ -0,0 +1,68 @@
+# Test setup, the plugin modules are imported as klippy 'extras'
+#
+# Copyright (C) 2025       Vinzenz Hassert
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import os
+import sys
+import types
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(os.path.dirname(TESTS_DIR), "source")
+sys.path.insert(0, TESTS_DIR)
+
+import klippy_stubs  # noqa: E402
+
+extras = types.ModuleType("extras")
+extras.__path__ = [SOURCE_DIR]
+sys.modules["extras"] = extras
+gcode_macro = types.ModuleType("extras.gcode_macro")
+gcode_macro.TemplateWrapper = klippy_stubs.TemplateWrapper
+gcode_macro.GetStatusWrapper = klippy_stubs.GetStatusWrapper
+sys.modules["extras.gcode_macro"] = gcode_macro
+extras.gcode_macro = gcode_macro
+
+BASE_OPTIONS = {
+    "min_temp": 0.0,
+    "max_temp": 80.0,
+    "target_temp": 40.0,
+    "control": "pid",
+    "pid_kp": 60.0,
+    "pid_ki": 0.5,
+    "pid_kd": 0.0,
+    "reverse": "true",
+    "state_save_interval": 0.0,
+}
+
+
+@pytest.fixture
+def printer(tmp_path):
+    return klippy_stubs.Printer(tmp_path)
+
+
+@pytest.fixture
+def make_servo(printer):
+    from extras import nevermore_servo
+
+    def make(name="chamber", profiles=None, **options):
+        sections = {}
+        for profile_name, profile_options in (profiles or {}).items():
+            section_name = "nevermore_servo_profile %s %s" % (name, profile_name)
+            profile_options = dict({"profile_version": 1}, **profile_options)
+            sections[section_name] = klippy_stubs.ConfigSection(
+                printer, section_name, profile_options
+            )
+        config = klippy_stubs.ConfigSection(
+            printer,
+            "nevermore_servo %s" % (name,),
+            dict(BASE_OPTIONS, **options),
+            sections,
+        )
+        servo = nevermore_servo.load_config_prefix(config)
+        printer.objects[config.get_name()] = servo
+        return servo
+
+    return make
@@ -0,0 +1,385 @@
+# Minimal stand-ins for the klippy objects used by nevermore_servo
+#
+# Copyright (C) 2025       Vinzenz Hassert
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import logging
+import threading
+
+SENTINEL = object()
+
+
+class ConfigError(Exception):
+    pass
+
+
+class CommandError(Exception):
+    pass
+
+
+def _check_range(error, name, value, minval, maxval, above, below):
+    if minval is not None and value < minval:
+        raise error("Option '%s' must have minimum of %s" % (name, minval))
+    if maxval is not None and value > maxval:
+        raise error("Option '%s' must have maximum of %s" % (name, maxval))
+    if above is not None and value <= above:
+        raise error("Option '%s' must be above %s" % (name, above))
+    if below is not None and value >= below:
+        raise error("Option '%s' must be below %s" % (name, below))
+    return value
+
+
+class Timer:
+    def __init__(self, callback, waketime):
+        self.callback = callback
+        self.waketime = waketime
+
+
+class Reactor:
+    # Simulated clock, timers only run from run_until()
+    NOW = 0.0
+    NEVER = 9999999999999999.0
+
+    def __init__(self, start_time=1000.0):
+        self.now = start_time
+        self.timers = []
+        self.async_lock = threading.Lock()
+        self.async_callbacks = []
+
+    def monotonic(self):
+        return self.now
+
+    def register_timer(self, callback, waketime=NEVER):
+        timer = Timer(callback, waketime)
+        self.timers.append(timer)
+        return timer
+
+    def update_timer(self, timer, waketime):
+        timer.waketime = waketime
+
+    def register_async_callback(self, callback, waketime=NOW):
+        # May be called from other threads, like the real reactor
+        with self.async_lock:
+            self.async_callbacks.append(callback)
+
+    def run_async_callbacks(self):
+        with self.async_lock:
+            callbacks = self.async_callbacks
+            self.async_callbacks = []
+        for callback in callbacks:
+            callback(self.now)
+        return len(callbacks)
+
+    def pause(self, waketime):
+        self.now = max(self.now, waketime)
+        self.run_async_callbacks()
+        return self.now
+
+    def run_until(self, end_time, lateness=None):
+        # lateness(waketime) returns how many seconds a timer fires too late
+        while True:
+            self.run_async_callbacks()
+            pending = [t for t in self.timers if t.waketime <= end_time]
+            if not pending:
+                break
+            timer = min(pending, key=lambda t: t.waketime)
+            eventtime = max(self.now, timer.waketime)
+            if lateness is not None:
+                eventtime += lateness(timer.waketime)
+            self.now = eventtime
+            timer.waketime = self.NEVER
+            timer.waketime = timer.callback(eventtime)
+        self.now = max(self.now, end_time)
+        self.run_async_callbacks()
+
+
+class ConfigSection:
+    def __init__(self, printer, name, options, sections=None):
+        self.printer = printer
+        self.name = name
+        self.options = dict(options)
+        self.sections = sections if sections is not None else {}
+        self.error = ConfigError
+
+    def get_printer(self):
+        return self.printer
+
+    def get_name(self):
+        return self.name
+
+    def get_prefix_sections(self, prefix):
+        return [s for n, s in self.sections.items() if n.startswith(prefix)]
+
+    def _get(self, key, default):
+        if key in self.options:
+            return self.options[key]
+        if default is SENTINEL:
+            raise ConfigError(
+                "Option '%s' in section '%s' must be specified" % (key, self.name)
+            )
+        return default
+
+    def get(self, key, default=SENTINEL):
+        value = self._get(key, default)
+        return value if value is None else str(value)
+
+    def getfloat(
+        self, key, default=SENTINEL, minval=None, maxval=None, above=None, below=None
+    ):
+        value = self._get(key, default)
+        if value is None or key not in self.options:
+            return value
+        value = float(value)
+        return _check_range(ConfigError, key, value, minval, maxval, above, below)
+
+    def getint(self, key, default=SENTINEL, minval=None, maxval=None):
+        value = self._get(key, default)
+        if value is None or key not in self.options:
+            return value
+        return _check_range(ConfigError, key, int(value), minval, maxval, None, None)
+
+    def getboolean(self, key, default=SENTINEL):
+        value = self._get(key, default)
+        if isinstance(value, str):
+            return value.lower() in ("true", "1")
+        return value
+
+    def getchoice(self, key, choices, default=SENTINEL):
+        value = self._get(key, default)
+        if value not in choices:
+            raise ConfigError("Choice '%s' for option '%s' is not valid" % (value, key))
+        return choices[value]
+
+    def getfloatlist(self, key, default=SENTINEL, sep=",", count=None):
+        value = self._get(key, default)
+        if value is None or not isinstance(value, str):
+            return value
+        return [float(v) for v in value.split(sep) if v.strip()]
+
+    def getlists(self, key, default=SENTINEL, seps=(",",), count=None, parser=str):
+        value = self._get(key, default)
+        if value is None or not isinstance(value, str):
+            return value
+        return tuple(parser(v.strip()) for v in value.split(seps[0]) if v.strip())
+
+
+class GCodeCommand:
+    def __init__(self, params, commandline="TEST"):
+        self.params = {k.upper(): str(v) for k, v in params.items()}
+        self.commandline = commandline
+        self.responses = []
+        self.error = CommandError
+
+    def get(
+        self,
+        name,
+        default=SENTINEL,
+        parser=str,
+        minval=None,
+        maxval=None,
+        above=None,
+        below=None,
+    ):
+        value = self.params.get(name)
+        if value is None:
+            if default is SENTINEL:
+                raise CommandError(
+                    "Error on '%s': missing %s" % (self.commandline, name)
+                )
+            return default
+        if parser is str:
+            return value
+        return _check_range(
+            CommandError, name, parser(value), minval, maxval, above, below
+        )
+
+    def get_float(
+        self, name, default=SENTINEL, minval=None, maxval=None, above=None, below=None
+    ):
+        return self.get(name, default, float, minval, maxval, above, below)
+
+    def get_int(self, name, default=SENTINEL, minval=None, maxval=None):
+        return self.get(name, default, int, minval, maxval)
+
+    def get_commandline(self):
+        return self.commandline
+
+    def respond_info(self, msg, log=True):
+        self.responses.append(msg)
+
+
+class GCode:
+    def __init__(self):
+        self.error = CommandError
+        self.mux_commands = {}
+        self.responses = []
+
+    def register_mux_command(self, cmd, key, value, func, desc=None):
+        self.mux_commands[(cmd, value)] = func
+
+    def register_command(self, cmd, func, desc=None):
+        self.mux_commands[(cmd, None)] = func
+
+    def respond_info(self, msg, log=True):
+        self.responses.append(msg)
+
+    def run(self, cmd, name, **params):
+        gcmd = GCodeCommand(params, cmd)
+        self.mux_commands[(cmd, name)](gcmd)
+        return gcmd
+
+
+class ConfigFile:
+    def __init__(self):
+        self.sections = {}
+
+    def set(self, section, option, value):
+        self.sections.setdefault(section, {})[option] = value
+
+    def remove_section(self, section):
+        self.sections.pop(section, None)
+
+
+class Sensor:
+    def __init__(self):
+        self.callback = None
+        self.min_temp = self.max_temp = None
+
+    def setup_minmax(self, min_temp, max_temp):
+        self.min_temp, self.max_temp = min_temp, max_temp
+
+    def setup_callback(self, callback):
+        self.callback = callback
+
+
+class Heater:
+    def __init__(self, power=0.0, target=0.0):
+        self.power = power
+        self.target = target
+
+    def get_status(self, eventtime):
+        return {"power": self.power, "target": self.target, "temperature": 0.0}
+
+
+class Heaters:
+    def __init__(self):
+        self.heaters = {}
+        self.available_sensors = []
+        self.available_heaters = []
+        self.sensors = []
+
+    def setup_sensor(self, config):
+        sensor = Sensor()
+        self.sensors.append(sensor)
+        return sensor
+
+    def register_sensor(self, config, psensor, gcode_id=None):
+        pass
+
+    def lookup_heater(self, name):
+        if name not in self.heaters:
+            raise ConfigError("Unknown heater '%s'" % (name,))
+        return self.heaters[name]
+
+
+class TemperatureSensor:
+    def __init__(self, temperature=25.0):
+        self.temperature = temperature
+
+    def get_status(self, eventtime):
+        return {"temperature": self.temperature}
+
+
+class Nevermore:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.commands = []
+
+    def set_vent_servo(self, percent, hold_for=None):
+        self.commands.append((self.reactor.monotonic(), percent, hold_for))
+
+
+class GCodeMacro:
+    env = None
+
+    def create_template_context(self, eventtime=None):
+        return {}
+
+
+class Template:
+    # Evaluates "{{ <python expression> }}" instead of Jinja
+    def __init__(self, script):
+        self.script = script.strip()
+
+    def render(self, context):
+        expression = self.script
+        if expression.startswith("{{") and expression.endswith("}}"):
+            expression = expression[2:-2]
+        return str(eval(expression, {}, dict(context)))
+
+
+class TemplateWrapper:
+    # Like klippy's, every failed render is logged before it is raised
+    def __init__(self, printer, env, name, script):
+        self.name = name
+        self.template = Template(script)
+
+    def render(self, context=None):
+        try:
+            return str(self.template.render(context or {}))
+        except Exception as e:
+            msg = "Error evaluating '%s': %s" % (self.name, e)
+            logging.exception(msg)
+            raise CommandError(msg)
+
+
+class GetStatusWrapper:
+    eventtimes = []
+
+    def __init__(self, printer, eventtime=None):
+        self.printer = printer
+        self.eventtime = eventtime
+        GetStatusWrapper.eventtimes.append(eventtime)
+
+    def __getitem__(self, name):
+        return self.printer.lookup_object(name).get_status(self.eventtime)
+
+
+class Printer:
+    config_error = ConfigError
+    command_error = CommandError
+
+    def __init__(self, config_dir):
+        self.reactor = Reactor()
+        self.event_handlers = {}
+        self.config_file = str(config_dir / "printer.cfg")
+        self.objects = {
+            "gcode": GCode(),
+            "configfile": ConfigFile(),
+            "heaters": Heaters(),
+            "gcode_macro": GCodeMacro(),
+        }
+        self.objects["nevermore"] = Nevermore(self.reactor)
+
+    def get_reactor(self):
+        return self.reactor
+
+    def get_start_args(self):
+        return {"config_file": self.config_file}
+
+    def lookup_object(self, name, default=SENTINEL):
+        if name in self.objects:
+            return self.objects[name]
+        if default is SENTINEL:
+            raise ConfigError("Unknown config object '%s'" % (name,))
+        return default
+
+    def load_object(self, config, name):
+        return self.lookup_object(name)
+
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
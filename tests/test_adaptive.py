@@ -0,0 +1,59 @@
+# Adaptive PID gains following a change of the chamber in closed loop
+#
+# Copyright (C) 2025       Vinzenz Hassert
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+from chamber import Chamber, run
+
+HOUR = 3600.0
+
+
+def test_gains_follow_a_faster_chamber(make_servo):
+    servo = make_servo(adaptive="true")
+    control = servo.get_control()
+    chamber = Chamber(seed=21)
+    end = run(servo, chamber, 1000.0, 8 * HOUR, interval=2.0)
+    status = control.get_status(end)["adaptive"]
+    # The first trusted estimate becomes the nominal model
+    assert status["nominal"]
+    assert abs(status["plant_gain"] + 30.0) < 6.0
+    assert abs(status["time_constant"] - 600.0) < 150.0
+    assert abs(status["pid_kp"] - 60.0) < 15.0
+    # Better insulation, the chamber settles twice as fast
+    chamber.tau = 300.0
+    end = run(servo, chamber, end + 2.0, 12 * HOUR, interval=2.0)
+    status = control.get_status(end)["adaptive"]
+    assert abs(status["time_constant"] - 300.0) < 100.0
+    assert status["pid_kp"] < 45.0
+    assert abs(status["pid_ki"] - 0.5) < 0.15
+    assert abs(chamber.temp - 40.0) < 1.0
+
+
+def test_gains_follow_a_stronger_heater(make_servo):
+    servo = make_servo(adaptive="true")
+    control = servo.get_control()
+    chamber = Chamber(seed=22)
+    end = run(servo, chamber, 1000.0, 8 * HOUR, interval=2.0)
+    assert control.get_status(end)["adaptive"]["nominal"]
+    # The flap now removes twice as much heat
+    chamber.heat = 60.0
+    chamber.ambient = 10.0
+    end = run(servo, chamber, end + 2.0, 12 * HOUR, interval=2.0)
+    status = control.get_status(end)["adaptive"]
+    assert abs(status["plant_gain"] + 60.0) < 15.0
+    assert status["pid_kp"] < 45.0
+    assert status["pid_ki"] < 0.4
+    assert abs(chamber.temp - 40.0) < 1.0
+
+
+def test_no_excitation_keeps_the_configured_gains(make_servo):
+    servo = make_servo(adaptive="true", adaptive_excitation=0.0)
+    control = servo.get_control()
+    chamber = Chamber(seed=23)
+    end = run(servo, chamber, 1000.0, 8 * HOUR, interval=2.0)
+    status = control.get_status(end)["adaptive"]
+    assert not status["nominal"]
+    assert status["excitation"] == 0.0
+    assert status["pid_kp"] == 60.0
+    assert status["pid_ki"] == 0.5
@@ -0,0 +1,57 @@
+# Disturbance detection on a noisy sample stream
+#
+# Copyright (C) 2025       Vinzenz Hassert
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+from chamber import Chamber, run
+
+DETECTOR_OPTIONS = {
+    "disturbance_slope": 0.05,
+    "disturbance_residual": 0.05,
+}
+
+
+def test_settled_noise_is_no_disturbance(make_servo):
+    servo = make_servo(**DETECTOR_OPTIONS)
+    chamber = Chamber(seed=13)
+    activations = []
+
+    def record(read_time, temp):
+        activations.append(servo.disturbance.active)
+        return temp
+
+    run(servo, chamber, 1000.0, 7200.0, noise=0.05, fault=record)
+    assert not any(activations[600:])
+    assert abs(chamber.temp - 40.0) < 0.5
+
+
+def test_door_opening_holds_the_flap(make_servo, printer):
+    servo = make_servo(**DETECTOR_OPTIONS)
+    nevermore = printer.objects["nevermore"]
+    chamber = Chamber(seed=14)
+    end = run(servo, chamber, 1000.0, 3600.0)
+    assert not servo.disturbance.active
+    control = servo.get_control()
+    # The open door cools the chamber quickly towards ambient
+    chamber.tau = 60.0
+    chamber.heat = 0.0
+    held = []
+
+    def record(read_time, temp):
+        if servo.disturbance.active:
+            held.append((len(nevermore.commands), control.prev_temp_integ))
+        return temp
+
+    end = run(servo, chamber, end + 1.0, 120.0, fault=record)
+    assert servo.disturbance.active
+    assert chamber.temp < 35.0
+    # Detected within seconds, from then on the flap and integrator are held
+    assert len(held) > 110
+    assert len(set(held)) == 1
+    # Door closed, the controller resumes once the chamber follows its trend
+    chamber.tau = 600.0
+    chamber.heat = 30.0
+    end = run(servo, chamber, end + 1.0, 3600.0)
+    assert not servo.disturbance.active
+    assert abs(chamber.temp - 40.0) < 1.0
@@ -0,0 +1,265 @@
+# Fault injection: bad readings, late and reordered samples, mode toggling
+# and concurrent target changes
+#
+# Copyright (C) 2025       Vinzenz Hassert
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import math
+import random
+import threading
+
+import pytest
+
+import klippy_stubs
+from chamber import Chamber, run
+
+MPC_PROFILE = {
+    "control": "mpc",
+    "pid_kp": 60.0,
+    "pid_ki": 0.5,
+    "pid_kd": 0.0,
+    "reverse": "true",
+    "mpc_plant_gain": -30.0,
+    "mpc_time_constant": 600.0,
+}
+FAST_PROFILE = {
+    "control": "pid",
+    "pid_kp": 120.0,
+    "pid_ki": 1.0,
+    "pid_kd": 0.0,
+    "reverse": "true",
+}
+
+
+def settle(servo, duration=3600.0, start=1000.0):
+    chamber = Chamber(seed=1)
+    end = run(servo, chamber, start, duration)
+    return chamber, end
+
+
+@pytest.mark.parametrize("bad", [None, float("nan")])
+def test_dropouts_hold_the_flap(make_servo, printer, bad):
+    servo = make_servo()
+    chamber, end = settle(servo)
+    commands = len(printer.objects["nevermore"].commands)
+    last_temp = servo.last_temp
+    percent = servo.last_percent
+    for i in range(60):
+        servo.sensor.callback(end + 1.0 + i, bad)
+    assert servo.sensor_dropouts == 60
+    assert len(printer.objects["nevermore"].commands) == commands
+    assert servo.last_temp == last_temp
+    assert servo.last_percent == percent
+    # The gap is bridged without leaving the control range
+    run(servo, chamber, end + 61.0, 1800.0)
+    assert 0.0 <= servo.last_percent <= 1.0
+    assert abs(chamber.temp - 40.0) < 1.0
+
+
+def test_zero_reading_is_a_measurement(make_servo, printer):
+    printer.objects["heaters"].heaters["heater_bed"] = klippy_stubs.Heater(0.5)
+    servo = make_servo(
+        control="feedforward",
+        feedforward_heaters="heater_bed",
+        feedforward_gain=10.0,
+    )
+    chamber, end = settle(servo)
+    servo.sensor.callback(end + 1.0, 0.0)
+    assert servo.sensor_dropouts == 0
+    assert servo.last_temp == 0.0
+    assert servo.get_status(end)["measured_min_temp"] == 0.0
+    # A cold chamber closes the flap
+    assert servo.last_percent == 0.0
+    # Print start re-evaluates the 0.0 sample in the sensor time base
+    nevermore = printer.objects["nevermore"]
+    nevermore.commands.clear()
+    servo.last_percent = 0.5
+    printer.reactor.now = end + 1e6
+    printer.send_event("idle_timeout:printing", end + 2e6)
+    assert servo.last_read_time == end + 1.0
+    assert [c[1] for c in nevermore.commands] == [0.0]
+
+
+def test_out_of_order_samples(make_servo):
+    servo = make_servo(dwell_time=30.0)
+    chamber, end = settle(servo)
+    control = servo.get_control()
+    integ = control.prev_temp_integ
+    last_move = control.quantiser.last_move_time
+    # A stale sample must not run the integrator backwards or skip the dwell
+    servo.sensor.callback(end - 120.0, 60.0)
+    assert control.prev_temp_integ == integ
+    assert control.quantiser.last_move_time == last_move
+    assert all(math.isfinite(v) for v in control.get_state().values())
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"adaptive": "true"}, MPC_PROFILE],
+    ids=["pid", "adaptive", "mpc"],
+)
+def test_reordered_samples_converge(make_servo, options):
+    servo = make_servo(**options)
+    chamber = Chamber(seed=2)
+    rng = random.Random(3)
+    callback = servo.sensor.callback
+    pending = []
+    read_time = 1000.0
+    for i in range(7200):
+        read_time += 1.0
+        servo.reactor.now = read_time
+        chamber.step(1.0, servo.last_percent)
+        pending.append((read_time, chamber.read(0.05)))
+        # Deliver in bursts with swapped neighbours
+        if len(pending) >= rng.randint(1, 4):
+            if len(pending) > 1:
+                pending[0], pending[1] = pending[1], pending[0]
+            for sample in pending:
+                callback(*sample)
+            pending = []
+        servo.reactor.run_async_callbacks()
+    servo.set_control(None)
+    assert abs(chamber.temp - 40.0) < 1.0
+    assert 0.0 <= servo.last_percent <= 1.0
+
+
+class ChamberSensor(klippy_stubs.TemperatureSensor):
+    # The chamber follows the reactor clock, whenever the timer runs
+    def __init__(self, chamber, nevermore_servo):
+        self.chamber = chamber
+        self.servo = nevermore_servo
+        self.prev_time = None
+
+    def get_status(self, eventtime):
+        if self.prev_time is not None and eventtime > self.prev_time:
+            self.chamber.step(eventtime - self.prev_time, self.servo.last_percent)
+        self.prev_time = eventtime
+        return {"temperature": self.chamber.read(0.05)}
+
+
+def test_late_timers(make_servo, printer):
+    servo = make_servo(temperature_sensor="chamber_sensor")
+    chamber = Chamber(seed=4)
+    printer.objects["chamber_sensor"] = ChamberSensor(chamber, servo)
+    read_times = []
+    callback = servo.temperature_callback
+
+    def record(read_time, temp):
+        read_times.append(read_time)
+        callback(read_time, temp)
+
+    servo.temperature_callback = record
+    printer.send_event("klippy:connect")
+    printer.send_event("klippy:ready")
+    rng = random.Random(5)
+
+    def lateness(waketime):
+        # Mostly jitter, sometimes the reactor stalls for a while
+        if rng.random() < 0.002:
+            return 30.0
+        return rng.uniform(0.0, 0.5)
+
+    printer.reactor.run_until(printer.reactor.now + 7200.0, lateness)
+    assert len(read_times) > 3600
+    assert all(b > a for a, b in zip(read_times, read_times[1:]))
+    assert abs(chamber.temp - 40.0) < 1.0
+
+
+def test_load_manual_toggling(make_servo, printer):
+    servo = make_servo(profiles={"mpc": MPC_PROFILE, "fast": FAST_PROFILE})
+    gcode = printer.objects["gcode"]
+    nevermore = printer.objects["nevermore"]
+    chamber = Chamber(seed=6)
+    rng = random.Random(7)
+    read_time = 1000.0
+    automatic = servo.get_control()
+    for i in range(300):
+        action = rng.choice(["LOAD", "LOAD", "MANUAL", "MANUAL", "RESUME"])
+        if action == "LOAD":
+            name = rng.choice(["default", "mpc", "fast"])
+            gcode.run("NEVERMORE_SERVO_PROFILE", "chamber", LOAD=name)
+            assert servo.get_control().get_profile()["name"] == name
+        elif action == "MANUAL":
+            gcode.run("NEVERMORE_SERVO_PROFILE", "chamber", MANUAL=1)
+            assert servo.get_control() is None
+        else:
+            gcode.run("NEVERMORE_SERVO_PROFILE", "chamber", MANUAL=0)
+            assert servo.get_control() is not None
+        if servo.get_control() is not None:
+            automatic = servo.get_control()
+        assert servo.pmgr.get_active_control() is automatic
+        commands = len(nevermore.commands)
+        read_time = run(servo, chamber, read_time + 1.0, 30.0)
+        if servo.get_control() is None:
+            assert len(nevermore.commands) == commands
+        assert servo.get_status(read_time)["control"] in ("manual", "pid", "mpc")
+    servo.set_control(None)
+    # Replaced MPC controls stop their solver threads
+    for thread in threading.enumerate():
+        if thread.name.startswith("nevermore_servo_mpc"):
+            thread.join(5.0)
+            assert not thread.is_alive()
+
+
+def test_concurrent_set_temp(make_servo, printer):
+    servo = make_servo()
+    chamber = Chamber(seed=8)
+    gcode = printer.objects["gcode"]
+    targets = [30.0, 35.0, 40.0, 45.0]
+    errors = []
+
+    def setter(seed):
+        rng = random.Random(seed)
+        try:
+            for i in range(500):
+                servo.set_temp(rng.choice(targets))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=setter, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    read_time = 1000.0
+    while any(thread.is_alive() for thread in threads):
+        read_time = run(servo, chamber, read_time + 1.0, 5.0)
+        gcode.run("NEVERMORE_SERVO_RAMP", "chamber", TARGET=50.0, RATE=1.0)
+    for thread in threads:
+        thread.join()
+    assert not errors
+    servo.set_temp(35.0)
+    assert servo.ramp is None
+    assert servo.target_temp == 35.0
+    with pytest.raises(klippy_stubs.CommandError):
+        gcode.run("SET_NEVERMORE_SERVO", "chamber", TARGET=95.0)
+    assert servo.target_temp == 35.0
+    run(servo, chamber, read_time + 1.0, 3600.0)
+    assert abs(chamber.temp - 35.0) < 1.0
+
+
+def test_template_renders_in_reactor(make_servo, printer, caplog):
+    servo = make_servo(
+        control="template",
+        template="{{ 1.0 if temperature > target else 0.0 }}",
+    )
+    reactor = printer.reactor
+    klippy_stubs.GetStatusWrapper.eventtimes = []
+    servo.sensor.callback(10.0, 50.0)
+    # Nothing is rendered in the sensor thread
+    assert klippy_stubs.GetStatusWrapper.eventtimes == []
+    reactor.now = 5000.0
+    reactor.run_async_callbacks()
+    assert klippy_stubs.GetStatusWrapper.eventtimes == [5000.0]
+    servo.sensor.callback(11.0, 50.0)
+    assert servo.last_percent == 1.0
+    # A broken template keeps the last value and is logged once a minute
+    servo.get_control().template.template = klippy_stubs.Template("{{ undefined }}")
+    for i in range(120):
+        reactor.now = 5001.0 + i
+        servo.sensor.callback(12.0 + i, 30.0)
+        reactor.run_async_callbacks()
+    assert servo.last_percent == 1.0
+    failures = [r for r in caplog.records if "template evaluation" in r.message]
+    assert len(failures) == 2
+    # The wrapper's own log message is bypassed as well
+    assert not [r for r in caplog.records if "Error evaluating" in r.message]
@@ -0,0 +1,43 @@
+# Flap position tracking and quantisation
+#
+# Copyright (C) 2025       Vinzenz Hassert
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+
+def test_release_keeps_the_position(make_servo, printer):
+    servo = make_servo()
+    nevermore = printer.objects["nevermore"]
+    nevermore.set_vent_servo(1.0)
+    nevermore.set_vent_servo(None)
+    assert servo.last_percent == 1.0
+    assert servo.vent.get_stats()["moves"] == 1
+    # A close is not swallowed by the deadband around a stale 0.0
+    servo.sensor.callback(1000.0, 20.0)
+    assert nevermore.commands[-1][1] == 0.0
+
+
+def test_positions_switch_with_hysteresis(make_servo):
+    servo = make_servo(flap_positions="0.0, 0.5, 1.0")
+    quantiser = servo.get_control().quantiser
+    # Requests chattering around the 0.75 midpoint leave the flap alone
+    for i, percent in enumerate([0.76, 0.74] * 10):
+        assert quantiser.update(float(i), percent, 0.5) is None
+        assert quantiser.update(float(i), percent, 1.0) is None
+    assert quantiser.update(30.0, 0.81, 0.5) == 1.0
+    assert quantiser.update(31.0, 0.69, 1.0) == 0.5
+    # Several positions are passed at once
+    assert quantiser.update(32.0, 0.9, 0.0) == 1.0
+    assert quantiser.update(33.0, 0.1, 1.0) == 0.0
+    assert quantiser.update(34.0, 0.22, 0.0) is None
+    assert quantiser.update(35.0, 0.31, 0.0) == 0.5
+
+
+def test_positions_tolerances_are_direction_aware(make_servo):
+    servo = make_servo(
+        flap_positions="0.0, 0.5, 1.0", open_tolerance=0.1, close_tolerance=0.0
+    )
+    quantiser = servo.get_control().quantiser
+    assert quantiser.update(0.0, 0.84, 0.5) is None
+    assert quantiser.update(1.0, 0.86, 0.5) == 1.0
+    assert quantiser.update(2.0, 0.74, 1.0) == 0.5
@@ -0,0 +1,37 @@
+# Klipper restarts: RESTART, FIRMWARE_RESTART and SAVE_CONFIG reload the
+# config within the same process, no thread may outlive its printer
+#
+# Copyright (C) 2025       Vinzenz Hassert
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import json
+
+from chamber import Chamber, run
+
+
+def test_state_writer_stops_on_disconnect(make_servo, printer, tmp_path):
+    state_file = tmp_path / "state.json"
+    servo = make_servo(state_save_interval=60.0, state_file=str(state_file))
+    printer.send_event("klippy:ready")
+    writer_thread = servo.state_store.writer_thread
+    assert writer_thread.is_alive()
+    run(servo, Chamber(seed=10), 1000.0, 600.0)
+    printer.send_event("klippy:disconnect")
+    assert not writer_thread.is_alive()
+    assert servo.state_store.writer_thread is None
+    # The final state is written before the thread is stopped
+    with open(state_file) as f:
+        assert json.load(f)["name"] == "chamber"
+
+
+def test_mpc_solver_stops_on_disconnect(make_servo, printer):
+    servo = make_servo(control="mpc", mpc_plant_gain=-30.0, mpc_time_constant=600.0)
+    control = servo.get_control()
+    run(servo, Chamber(seed=11), 1000.0, 60.0)
+    solver_thread = control.solver_thread
+    assert solver_thread.is_alive()
+    printer.send_event("klippy:disconnect")
+    solver_thread.join(5.0)
+    assert not solver_thread.is_alive()
+
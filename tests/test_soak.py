@@ -0,0 +1,142 @@
+# Long run soak: days of simulated runtime with slowly changing conditions
+# and sporadic faults, checking that memory, CPU time per sample and servo
+# activity stay bounded
+#
+# Copyright (C) 2025       Vinzenz Hassert
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import math
+import os
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+from chamber import Chamber
+
+SOAK_DAYS = float(os.environ.get("NEVERMORE_SOAK_DAYS", "2"))
+HOUR = 3600.0
+DAY = 24 * HOUR
+WARMUP = 6 * HOUR
+# tracemalloc slows the run down, only the end of it is traced
+MEMORY_WINDOW = 12 * HOUR
+# Bounds for the settled chamber
+MAX_MEMORY_GROWTH = 64 * 1024
+MAX_SAMPLE_CPU_TIME = 0.002
+# Servo wear budget, one move per 30 seconds on average. It does not depend
+# on dwell_time, the default configuration has none.
+MAX_MOVES_PER_HOUR = 120
+MAX_TEMP_ERROR = 1.0
+SOLVER_TIMEOUT = 5.0
+
+DWELL_OPTIONS = {"hold_mode": "adaptive", "dwell_time": 60.0}
+MPC_OPTIONS = dict(
+    DWELL_OPTIONS,
+    control="mpc",
+    mpc_plant_gain=-30.0,
+    mpc_time_constant=600.0,
+)
+
+
+def conditions(chamber, read_time):
+    # Day and night ambient cycle and prints starting every six hours
+    chamber.ambient = 25.0 + 3.0 * math.sin(2.0 * math.pi * read_time / DAY)
+    chamber.heat = 30.0 if (read_time // (6 * HOUR)) % 2 else 35.0
+
+
+def wait_for_plans(servo, control):
+    # The solver thread still does the work, but each sample waits for its
+    # plan so the run is repeatable
+    solved = threading.Event()
+    register_async_callback = servo.reactor.register_async_callback
+    submit = control._submit
+
+    def register_and_signal(callback, *args):
+        register_async_callback(callback, *args)
+        solved.set()
+
+    def submit_and_wait(request):
+        solved.clear()
+        submit(request)
+        assert solved.wait(SOLVER_TIMEOUT), "no plan from the solver thread"
+
+    servo.reactor.register_async_callback = register_and_signal
+    control._submit = submit_and_wait
+
+
+@pytest.mark.parametrize(
+    "options, interval",
+    [
+        ({}, 2.0),
+        (DWELL_OPTIONS, 2.0),
+        (dict(DWELL_OPTIONS, adaptive="true"), 2.0),
+        (MPC_OPTIONS, 5.0),
+    ],
+    ids=["default", "pid", "adaptive", "mpc"],
+)
+def test_soak(make_servo, printer, options, interval):
+    servo = make_servo(**options)
+    control = servo.get_control()
+    if options is MPC_OPTIONS:
+        wait_for_plans(servo, control)
+    nevermore = printer.objects["nevermore"]
+    chamber = Chamber(seed=9)
+    callback = servo.sensor.callback
+    reactor = servo.reactor
+    rng = chamber.rng
+    end = SOAK_DAYS * DAY
+    traced = end - MEMORY_WINDOW
+    samples = 0
+    cpu_time = 0.0
+    moves = []
+    max_error = 0.0
+    read_time = 0.0
+    while read_time < end:
+        read_time += interval
+        reactor.now = read_time
+        conditions(chamber, read_time)
+        chamber.step(interval, servo.last_percent)
+        temp = chamber.read(0.05)
+        if rng.random() < 0.001:
+            temp = rng.choice([None, float("nan")])
+        if read_time < WARMUP:
+            callback(read_time, temp)
+            reactor.run_async_callbacks()
+            continue
+        if not samples:
+            nevermore.commands.clear()
+            hour_start = read_time
+        if read_time < traced:
+            start = time.process_time()
+            callback(read_time, temp)
+            reactor.run_async_callbacks()
+            cpu_time += time.process_time() - start
+        else:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                memory_start = tracemalloc.get_traced_memory()[0]
+            callback(read_time, temp)
+            reactor.run_async_callbacks()
+        samples += 1
+        max_error = max(max_error, abs(chamber.temp - servo.target_temp))
+        if read_time - hour_start >= HOUR:
+            moves.append(len(nevermore.commands))
+            nevermore.commands.clear()
+            hour_start = read_time
+    memory_growth = tracemalloc.get_traced_memory()[0] - memory_start
+    tracemalloc.stop()
+    sample_cpu_time = cpu_time / ((traced - WARMUP) / interval)
+    assert memory_growth < MAX_MEMORY_GROWTH, "%d bytes" % (memory_growth,)
+    assert sample_cpu_time < MAX_SAMPLE_CPU_TIME, "%.6fs" % (sample_cpu_time,)
+    assert max(moves) <= MAX_MOVES_PER_HOUR, moves
+    assert max_error < MAX_TEMP_ERROR, "%.2f" % (max_error,)
+    assert servo.sensor_dropouts > 0
+    if options is MPC_OPTIONS:
+        solver_thread = control.solver_thread
+        assert solver_thread.is_alive()
+        assert not control.fallback
+        printer.send_event("klippy:disconnect")
+        solver_thread.join(SOLVER_TIMEOUT)
+        assert not solver_thread.is_alive()